@@ -1,9 +1,11 @@
 import streamlit as st
 import os
 import io
+import time
 import pandas as pd
 from datetime import datetime
-from motor_fiscal import extrair_dados_xml, gerar_excel_final
+from motor_fiscal import limpar_armazem, CAMINHOS_BASES, PASTA_BASES
+from executor_auditoria import iniciar_auditoria, estado_tarefa, ETAPAS
 
 # --- CONFIGURAÇÃO VISUAL ---
 st.set_page_config(page_title="Sentinela", page_icon="🧡", layout="wide")
@@ -28,6 +30,16 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+TIPOS_XML = ['xml', 'zip', 'tar', 'gz', 'tgz']
+ARMAZEM_XML = os.path.join(PASTA_BASES, "extracoes.sqlite")
+FORMATOS = {
+    "Excel (padrão)": ("xlsx", "Auditoria_Sentinela_Completa.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "Excel grande (valores numéricos)": ("xlsx_streaming", "Auditoria_Sentinela_Completa.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "CSV por aba (ZIP)": ("csv", "Auditoria_Sentinela_CSV.zip", "application/zip"),
+    "Parquet por aba (ZIP)": ("parquet", "Auditoria_Sentinela_Parquet.zip", "application/zip"),
+}
+CANCELADAS = {"Excluir da auditoria": "excluir", "Manter e sinalizar": "sinalizar"}
+
 # --- INICIALIZAÇÃO DE ESTADO PARA LIMPEZA ---
 if 'xml_ent_key' not in st.session_state: st.session_state.xml_ent_key = 0
 if 'xml_sai_key' not in st.session_state: st.session_state.xml_sai_key = 0
@@ -52,21 +64,34 @@ with st.sidebar:
     with st.expander("🔄 **Atualizar Base ICMS**"):
         up_icms = st.file_uploader("Arquivo ICMS", type=['xlsx'], key='base_i', label_visibility="collapsed")
         if up_icms:
-            with open(".streamlit/Base_ICMS.xlsx", "wb") as f: f.write(up_icms.getbuffer())
+            with open(CAMINHOS_BASES['icms'], "wb") as f: f.write(up_icms.getbuffer())
             st.toast("Base ICMS atualizada!", icon="✅")
 
     with st.expander("🔄 **Atualizar Base PIS/COF**"):
         up_pis = st.file_uploader("Arquivo PIS", type=['xlsx'], key='base_p', label_visibility="collapsed")
         if up_pis:
-            with open(".streamlit/Base_CST_Pis_Cofins.xlsx", "wb") as f: f.write(up_pis.getbuffer())
+            with open(CAMINHOS_BASES['pis_cofins'], "wb") as f: f.write(up_pis.getbuffer())
             st.toast("Base PIS/COF atualizada!", icon="✅")
 
     with st.expander("🔄 **Atualizar Base TIPI**"):
         up_tipi = st.file_uploader("Arquivo TIPI", type=['xlsx'], key='base_t', label_visibility="collapsed")
         if up_tipi:
-            with open(".streamlit/Base_IPI_Tipi.xlsx", "wb") as f: f.write(up_tipi.getbuffer())
+            with open(CAMINHOS_BASES['tipi'], "wb") as f: f.write(up_tipi.getbuffer())
             st.toast("Base TIPI atualizada!", icon="✅")
 
+    st.markdown("### 📄 Relatório")
+    formato_rel = st.selectbox("Formato", list(FORMATOS), key="formato_rel", label_visibility="collapsed")
+    canceladas_rel = st.radio("Notas canceladas/denegadas", list(CANCELADAS), key="canceladas_rel")
+
+    st.markdown("### 🗄️ Cache de Extração")
+    usar_armazem = st.toggle("Reaproveitar notas já lidas", value=True, help="Só os XMLs novos ou alterados são lidos novamente")
+    empresa = st.text_input("Empresa (CNPJ)", key="empresa").strip()
+    with st.expander("🧹 **Limpar Cache**"):
+        periodo_limpar = st.text_input("Período (AAAA-MM, vazio = todos)", key="periodo_limpar").strip()
+        if st.button("Limpar", key="btn_limpar_cache") and os.path.exists(ARMAZEM_XML):
+            n = limpar_armazem(ARMAZEM_XML, empresa=empresa, periodo=periodo_limpar or None)
+            st.toast(f"{n} nota(s) removida(s) do cache.", icon="🧹")
+
 # --- ÁREA CENTRAL ---
 c1, c2, c3 = st.columns([3, 4, 3])
 with c2:
@@ -85,7 +110,7 @@ with col_ent:
             st.session_state.xml_ent_key += 1
             st.rerun()
             
-    xml_ent = st.file_uploader("📂 XMLs de Entrada", type='xml', accept_multiple_files=True, key=f"xml_e_{st.session_state.xml_ent_key}")
+    xml_ent = st.file_uploader("📂 XMLs de Entrada (ou ZIP/TAR)", type=TIPOS_XML, accept_multiple_files=True, key=f"xml_e_{st.session_state.xml_ent_key}")
     aut_ent = st.file_uploader("🔍 Autenticidade Entrada", type=['xlsx'], key="ae")
     ger_ent = st.file_uploader("📊 Gerenc. Entradas (CSV)", type=['csv'], key="ge")
 
@@ -97,36 +122,68 @@ with col_sai:
             st.session_state.xml_sai_key += 1
             st.rerun()
 
-    xml_sai = st.file_uploader("📂 XMLs de Saída", type='xml', accept_multiple_files=True, key=f"xml_s_{st.session_state.xml_sai_key}")
+    xml_sai = st.file_uploader("📂 XMLs de Saída (ou ZIP/TAR)", type=TIPOS_XML, accept_multiple_files=True, key=f"xml_s_{st.session_state.xml_sai_key}")
     aut_sai = st.file_uploader("🔍 Autenticidade Saída", type=['xlsx'], key="as")
     ger_sai = st.file_uploader("📊 Gerenc. Saídas (CSV)", type=['csv'], key="gs")
 
 # --- EXECUÇÃO ---
+# A auditoria roda em segundo plano (executor_auditoria); a sessão guarda só a chave da tarefa e acompanha o andamento
 st.markdown("<br>", unsafe_allow_html=True)
 if st.button("🚀 EXECUTAR AUDITORIA", type="primary", use_container_width=True):
     if not xml_ent and not xml_sai:
         st.error("Por favor, carregue os arquivos XML.")
     else:
         try:
-            with st.spinner("O Sentinela está processando... 🧡"):
-                df_autent_data = None
-                arq_aut = aut_sai if aut_sai else aut_ent
-                if arq_aut:
-                    df_autent_data = pd.read_excel(arq_aut)
-
-                df_e = extrair_dados_xml(xml_ent, "Entrada", df_autenticidade=df_autent_data)
-                df_s = extrair_dados_xml(xml_sai, "Saída", df_autenticidade=df_autent_data)
-                
-                excel_binario = gerar_excel_final(df_e, df_s, file_ger_ent=ger_ent, file_ger_sai=ger_sai)
-                
-                if excel_binario:
-                    st.success("Análise concluída! 🧡")
-                    st.download_button(
-                        label="💾 BAIXAR RELATÓRIO",
-                        data=excel_binario,
-                        file_name="Auditoria_Sentinela_Completa.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        use_container_width=True
-                    )
+            st.session_state.tarefa = iniciar_auditoria(
+                xml_ent, xml_sai, ger_ent=ger_ent, ger_sai=ger_sai, aut_ent=aut_ent, aut_sai=aut_sai, formato=FORMATOS[formato_rel][0],
+                canceladas=CANCELADAS[canceladas_rel], armazem=ARMAZEM_XML if usar_armazem else None, empresa=empresa)
         except Exception as e:
             st.error(f"Erro crítico no processamento: {e}")
+
+@st.fragment(run_every=1.0)
+def acompanhar_tarefa(chave):
+    tarefa = estado_tarefa(chave)
+    if tarefa is None or tarefa['status'] in ("concluida", "erro"): st.rerun(scope="app")
+    if tarefa['status'] == "fila":
+        st.info("⏳ Aguardando na fila do Sentinela...")
+        return
+    decorrido = time.time() - tarefa['inicio']
+    st.progress(tarefa['passo'] / len(ETAPAS), text=f"O Sentinela está processando... 🧡 {ETAPAS.get(tarefa['etapa'], '')}")
+    st.caption(f"{tarefa['notas']:,} nota(s) lida(s) · {decorrido:,.0f}s".replace(",", "."))
+
+def mostrar_resultado(tarefa):
+    resumo = tarefa['resumo']; metricas = resumo['metricas']
+    if resumo['ignorados'] or resumo['duplicados']:
+        st.info(f"{resumo['ignorados']} arquivo(s) não-XML ignorado(s) e {resumo['duplicados']} nota(s) com chave duplicada descartada(s).")
+    if resumo['falhas']:
+        st.warning(f"{len(resumo['falhas'])} arquivo(s) não puderam ser lidos e ficaram fora da auditoria.")
+        with st.expander("Ver arquivos com falha"):
+            st.dataframe(pd.DataFrame(resumo['falhas'], columns=['ARQUIVO', 'ERRO']), use_container_width=True)
+
+    cancelados = sum(metricas.get('itens_cancelados', {}).values())
+    if cancelados:
+        acao = "excluído(s) das abas de auditoria" if tarefa['opcoes']['canceladas'] == "excluir" else "mantido(s) e sinalizado(s)"
+        st.info(f"{cancelados} item(ns) de notas canceladas/denegadas {acao}.")
+    sem_xml = metricas.get('abas', {}).get('Autenticidade sem XML', 0)
+    if sem_xml: st.warning(f"{sem_xml} chave(s) da autenticidade sem XML correspondente (aba 'Autenticidade sem XML').")
+
+    if tarefa['resultado']:
+        _, nome_arquivo, mime = next(v for v in FORMATOS.values() if v[0] == tarefa['opcoes']['formato'])
+        st.success(f"Análise concluída em {tarefa['fim'] - tarefa['inicio']:,.0f}s! 🧡".replace(",", "."))
+        extracao = resumo.get('extracao', {})
+        memoria_df = sum(m.get('memoria_df_mb', 0) for m in extracao.values())
+        picos = [m['pico_memoria_mb'] for m in (*extracao.values(), metricas) if m.get('pico_memoria_mb')]
+        if picos: st.caption(f"Pico de memória: {max(picos):,.0f} MB · itens extraídos em memória: {memoria_df:,.1f} MB")
+        st.download_button(
+            label="💾 BAIXAR RELATÓRIO",
+            data=tarefa['resultado'],
+            file_name=nome_arquivo,
+            mime=mime,
+            use_container_width=True
+        )
+
+tarefa = estado_tarefa(st.session_state.tarefa) if st.session_state.get('tarefa') else None
+if tarefa is None: st.session_state.pop('tarefa', None)
+elif tarefa['status'] == "erro": st.error(f"Erro crítico no processamento: {tarefa['erro']}")
+elif tarefa['status'] == "concluida": mostrar_resultado(tarefa)
+else: acompanhar_tarefa(tarefa['chave'])
@@ -0,0 +1,108 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import motor_fiscal as mf
+from gerador_nfe import gerar_zip
+
+# Benchmark de escala do motor_fiscal: mede extração, cada aba de auditoria e a escrita do Excel para
+# 1k/10k/100k/1M itens (ou os tamanhos pedidos). Cada tamanho roda num subprocesso para o pico de RSS ser
+# só daquele tamanho. O resultado pode ser comparado com uma baseline gravada para acusar regressões.
+#   python benchmarks/bench_motor.py                       # roda e compara com benchmarks/baseline.json (se existir)
+#   python benchmarks/bench_motor.py --salvar-baseline     # grava a baseline desta máquina
+
+TAMANHOS_PADRAO = (1_000, 10_000, 100_000, 1_000_000)
+ITENS_POR_NOTA = 10
+MIN_SEGUNDOS_COMPARACAO = 0.5  # etapas mais curtas que isso na baseline variam demais para acusar regressão
+BASELINE_PADRAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+def _medir(etapas, nome, itens, fn):
+    t0 = time.perf_counter(); resultado = fn(); dt = time.perf_counter() - t0
+    etapas[nome] = {"segundos": round(dt, 3), "itens_s": round(itens / dt, 1) if dt > 0 else None}
+    return resultado
+
+def rodar_tamanho(itens, workers=None, formato="xlsx_streaming"):
+    notas = max(1, itens // ITENS_POR_NOTA)
+    zip_notas = gerar_zip(notas, ITENS_POR_NOTA, pct_malformados=0.01, semente=itens)
+    base_icms, base_pc, base_tipi = mf._carregar_bases()
+    etapas = {}
+    df = _medir(etapas, "extracao", itens, lambda: mf.extrair_dados_xml([zip_notas], "Saída", workers=workers))
+    n = len(df); numerico = formato != "xlsx"
+    abas = [("SAIDAS", df)]
+    abas.append(("ICMS", _medir(etapas, "aba_icms", n, lambda: mf.auditar_icms(df, df, base_icms, numerico=numerico))))
+    abas.append(("PIS_COFINS", _medir(etapas, "aba_pis_cofins", n, lambda: mf.auditar_pis_cofins(df, base_pc, numerico=numerico))))
+    abas.append(("IPI", _medir(etapas, "aba_ipi", n, lambda: mf.auditar_ipi(df, base_pc, base_tipi, numerico=numerico))))
+    abas.append(("DIFAL", _medir(etapas, "aba_difal", n, lambda: mf.auditar_difal(df, numerico=numerico))))
+    abas.append(("ICMS_Destino", _medir(etapas, "aba_icms_destino", n, lambda: mf.resumo_icms_destino(df, numerico))))
+    with tempfile.TemporaryDirectory() as tmp:
+        destino = os.path.join(tmp, "relatorio.xlsx")
+        if formato == "xlsx": _medir(etapas, "escrita_excel", n, lambda: mf._escrever_xlsx_memoria(abas))
+        else: _medir(etapas, "escrita_excel", n, lambda: mf._escrever_xlsx_streaming(abas, destino))
+    total = sum(e["segundos"] for e in etapas.values())
+    return {"itens": n, "notas": notas, "falhas": len(df.attrs.get("falhas", [])), "etapas": etapas,
+            "total_s": round(total, 3), "itens_s": round(n / total, 1) if total else None, "pico_rss_mb": mf._pico_memoria_mb()}
+
+def _rodar_em_subprocesso(itens, workers, formato):
+    cmd = [sys.executable, os.path.abspath(__file__), "--_um", str(itens), "--formato", formato]
+    if workers: cmd += ["--workers", str(workers)]
+    saida = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+    return json.loads(saida.strip().splitlines()[-1])
+
+def comparar(atual, baseline, tolerancia):
+    # Regressão: vazão (itens/s) abaixo de (1 - tolerância) da baseline ou pico de RSS acima de (1 + tolerância)
+    regressoes = []
+    for tamanho, res in atual.items():
+        ref = baseline.get(tamanho)
+        if not ref: continue
+        for etapa, med in res["etapas"].items():
+            ref_etapa = ref["etapas"].get(etapa)
+            if not ref_etapa or ref_etapa["segundos"] < MIN_SEGUNDOS_COMPARACAO: continue
+            if ref_etapa["itens_s"] and med["itens_s"] and med["itens_s"] < ref_etapa["itens_s"] * (1 - tolerancia):
+                regressoes.append(f"{tamanho} itens / {etapa}: {med['itens_s']:,.0f} itens/s (baseline {ref_etapa['itens_s']:,.0f})")
+        if ref.get("pico_rss_mb") and res.get("pico_rss_mb") and res["pico_rss_mb"] > ref["pico_rss_mb"] * (1 + tolerancia):
+            regressoes.append(f"{tamanho} itens / pico RSS: {res['pico_rss_mb']:,.0f} MB (baseline {ref['pico_rss_mb']:,.0f} MB)")
+    return regressoes
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Benchmark de escala do motor_fiscal.")
+    p.add_argument("--tamanhos", type=int, nargs="*", default=list(TAMANHOS_PADRAO), help="nº de itens por rodada")
+    p.add_argument("--workers", type=int)
+    p.add_argument("--formato", choices=("xlsx", "xlsx_streaming"), default="xlsx_streaming")
+    p.add_argument("--baseline", default=BASELINE_PADRAO)
+    p.add_argument("--salvar-baseline", action="store_true")
+    p.add_argument("--tolerancia", type=float, default=0.2, help="variação aceita em relação à baseline (0.2 = 20%%)")
+    p.add_argument("--saida", help="grava o resultado em JSON")
+    p.add_argument("--_um", type=int, help=argparse.SUPPRESS)
+    args = p.parse_args(argv)
+
+    if args._um:
+        print(json.dumps(rodar_tamanho(args._um, args.workers, args.formato)))
+        return 0
+
+    resultados = {}
+    for itens in args.tamanhos:
+        res = resultados[str(itens)] = _rodar_em_subprocesso(itens, args.workers, args.formato)
+        etapas = "  ".join(f"{k}={v['segundos']:.2f}s" for k, v in res["etapas"].items())
+        print(f"{res['itens']:>9,} itens  {res['itens_s']:>10,.0f} itens/s  pico {res['pico_rss_mb'] or 0:>8,.0f} MB  {etapas}")
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f: json.dump(resultados, f, indent=2)
+    if args.salvar_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f: json.dump(resultados, f, indent=2)
+        print(f"Baseline gravada em {args.baseline}")
+        return 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f: regressoes = comparar(resultados, json.load(f), args.tolerancia)
+        for r in regressoes: print(f"REGRESSÃO: {r}")
+        if regressoes: return 1
+        print("Sem regressões em relação à baseline.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
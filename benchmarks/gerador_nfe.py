@@ -0,0 +1,132 @@
+import argparse
+import io
+import os
+import random
+import sys
+import zipfile
+
+# Gerador de NF-e sintéticas (layout nfeProc/NFe/infNFe com namespace do portal fiscal) para benchmarks e
+# comparação de motores. Cada nota sorteia UFs, CFOPs e variantes de ICMS/PIS/COFINS/IPI (entre as escolhidas) e,
+# nas interestaduais, o grupo de DIFAL com a taxa pedida; uma fração configurável sai malformada (XML truncado,
+# sem <dest>, valor não numérico).
+
+NS = "http://www.portalfiscal.inf.br/nfe"
+UFS = ["SP", "RJ", "MG", "PR", "SC", "RS", "BA", "GO", "PE", "CE"]
+CODIGO_UF = {"SP": "35", "RJ": "33", "MG": "31", "PR": "41", "SC": "42", "RS": "43", "BA": "29", "GO": "52", "PE": "26", "CE": "23"}
+NCMS = ["02013000", "02023000", "22030000", "22021000", "84713012", "85171231", "30049099", "39269090", "87089990", "61091000"]
+VARIANTES_ICMS = ("00", "10", "20", "40", "60", "SN102")
+VARIANTES_PC = ("Aliq", "NT")
+VARIANTES_IPI = ("Trib", "NT", "sem")
+TAXA_DIFAL = 0.7  # fração dos itens interestaduais com grupo ICMSUFDest
+MALFORMACOES = ("truncado", "sem_dest", "valor_invalido")
+
+def _v(x): return f"{x:.2f}"
+
+def _icms(rng, variante, v_prod):
+    if variante == "SN102": return "<ICMS><ICMSSN102><orig>0</orig><CSOSN>102</CSOSN></ICMSSN102></ICMS>"
+    if variante in ("40", "60"):
+        extra = f"<vBCSTRet>{_v(v_prod)}</vBCSTRet><vICMSSTRet>{_v(v_prod * 0.18)}</vICMSSTRet>" if variante == "60" else ""
+        return f"<ICMS><ICMS{variante}><orig>0</orig><CST>{variante}</CST>{extra}</ICMS{variante}></ICMS>"
+    aliq = rng.choice((4.0, 7.0, 12.0, 18.0)); bc = v_prod * (0.4167 if variante == "20" else 1.0)
+    st = ""
+    if variante == "10":
+        bc_st = v_prod * 1.4; st = f"<modBCST>4</modBCST><vBCST>{_v(bc_st)}</vBCST><pICMSST>18.00</pICMSST><vICMSST>{_v(bc_st * 0.18 - bc * aliq / 100)}</vICMSST><vFCPST>{_v(bc_st * 0.02)}</vFCPST>"
+    red = "<pRedBC>58.33</pRedBC>" if variante == "20" else ""
+    return (f"<ICMS><ICMS{variante}><orig>0</orig><CST>{variante}</CST><modBC>3</modBC>{red}<vBC>{_v(bc)}</vBC>"
+            f"<pICMS>{aliq:.2f}</pICMS><vICMS>{_v(bc * aliq / 100)}</vICMS>{st}</ICMS{variante}></ICMS>")
+
+def _pis_cofins(variante, v_prod):
+    if variante == "NT": return "<PIS><PISNT><CST>06</CST></PISNT></PIS><COFINS><COFINSNT><CST>06</CST></COFINSNT></COFINS>"
+    return (f"<PIS><PISAliq><CST>01</CST><vBC>{_v(v_prod)}</vBC><pPIS>1.65</pPIS><vPIS>{_v(v_prod * 0.0165)}</vPIS></PISAliq></PIS>"
+            f"<COFINS><COFINSAliq><CST>01</CST><vBC>{_v(v_prod)}</vBC><pCOFINS>7.60</pCOFINS><vCOFINS>{_v(v_prod * 0.076)}</vCOFINS></COFINSAliq></COFINS>")
+
+def _ipi(variante, v_prod):
+    if variante == "sem": return ""
+    if variante == "NT": return "<IPI><cEnq>999</cEnq><IPINT><CST>53</CST></IPINT></IPI>"
+    return f"<IPI><cEnq>999</cEnq><IPITrib><CST>50</CST><vBC>{_v(v_prod)}</vBC><pIPI>6.50</pIPI><vIPI>{_v(v_prod * 0.065)}</vIPI></IPITrib></IPI>"
+
+def _difal(v_prod):
+    return (f"<ICMSUFDest><vBCUFDest>{_v(v_prod)}</vBCUFDest><pFCPUFDest>2.00</pFCPUFDest><pICMSUFDest>18.00</pICMSUFDest>"
+            f"<pICMSInter>12.00</pICMSInter><pICMSInterPart>100.00</pICMSInterPart><vFCPUFDest>{_v(v_prod * 0.02)}</vFCPUFDest>"
+            f"<vICMSUFDest>{_v(v_prod * 0.06)}</vICMSUFDest><vICMSUFRemet>0.00</vICMSUFRemet></ICMSUFDest>")
+
+def gerar_nota(rng, numero, itens_por_nota, malformacao=None, icms=VARIANTES_ICMS, pis_cofins=VARIANTES_PC, ipi=VARIANTES_IPI,
+               taxa_difal=TAXA_DIFAL):
+    uf_e = rng.choice(UFS); uf_d = uf_e if rng.random() < 0.5 else rng.choice(UFS)
+    interestadual = uf_e != uf_d
+    chave = f"{CODIGO_UF[uf_e]}2401{rng.randrange(10**14):014d}55001{numero:09d}1{rng.randrange(10**8):08d}"
+    chave += str(sum(int(c) for c in chave) % 10)
+    dets = []
+    for i in range(1, itens_por_nota + 1):
+        v_prod = round(rng.uniform(1, 5000), 2)
+        cfop = rng.choice(("6102", "6108", "6404", "6933") if interestadual else ("5102", "5405", "5101"))
+        v_prod_txt = "abc" if malformacao == "valor_invalido" and i == itens_por_nota else _v(v_prod)
+        imposto = _icms(rng, rng.choice(icms), v_prod) + _ipi(rng.choice(ipi), v_prod) + _pis_cofins(rng.choice(pis_cofins), v_prod)
+        if interestadual and rng.random() < taxa_difal: imposto += _difal(v_prod)
+        dets.append(
+            f'<det nItem="{i}"><prod><cProd>P{rng.randrange(10**5):05d}</cProd><cEAN>SEM GTIN</cEAN><xProd>Produto sintético {i}</xProd>'
+            f"<NCM>{rng.choice(NCMS)}</NCM><CFOP>{cfop}</CFOP><uCom>UN</uCom><qCom>1.0000</qCom><vUnCom>{v_prod_txt}</vUnCom>"
+            f"<vProd>{v_prod_txt}</vProd><indTot>1</indTot></prod><imposto><vTotTrib>0.00</vTotTrib>{imposto}</imposto></det>")
+    dest = "" if malformacao == "sem_dest" else (
+        f"<dest><CNPJ>{rng.randrange(10**14):014d}</CNPJ><xNome>Cliente</xNome><enderDest><xLgr>Rua B</xLgr><UF>{uf_d}</UF></enderDest></dest>")
+    xml = (f'<?xml version="1.0" encoding="UTF-8"?><nfeProc xmlns="{NS}" versao="4.00"><NFe xmlns="{NS}">'
+           f'<infNFe Id="NFe{chave}" versao="4.00"><ide><cUF>{CODIGO_UF[uf_e]}</cUF><mod>55</mod><serie>1</serie><nNF>{numero}</nNF>'
+           f"<dhEmi>2024-01-{1 + numero % 28:02d}T{numero % 24:02d}:15:00-03:00</dhEmi><tpNF>1</tpNF></ide>"
+           f"<emit><CNPJ>12345678000199</CNPJ><xNome>Emitente</xNome><enderEmit><xLgr>Rua A</xLgr><UF>{uf_e}</UF></enderEmit></emit>"
+           f"{dest}{''.join(dets)}<total><ICMSTot><vNF>0.00</vNF></ICMSTot></total></infNFe>"
+           f'<Signature xmlns="http://www.w3.org/2000/09/xmldsig#"><SignedInfo/></Signature></NFe>'
+           f"<protNFe versao=\"4.00\"><infProt><chNFe>{chave}</chNFe><cStat>100</cStat></infProt></protNFe></nfeProc>").encode("utf-8")
+    if malformacao == "truncado": xml = xml[: len(xml) // 2]
+    return chave, xml
+
+def _validar_variantes(icms, pis_cofins, ipi, taxa_difal):
+    for nome, escolhidas, validas in (("ICMS", icms, VARIANTES_ICMS), ("PIS/COFINS", pis_cofins, VARIANTES_PC), ("IPI", ipi, VARIANTES_IPI)):
+        invalidas = [v for v in escolhidas if v not in validas]
+        if not escolhidas or invalidas: raise ValueError(f"Variantes de {nome} inválidas: {invalidas or 'nenhuma escolhida'} (válidas: {validas})")
+    if not 0.0 <= taxa_difal <= 1.0: raise ValueError(f"Taxa de DIFAL fora de 0 a 1: {taxa_difal}")
+
+def gerar_notas(n_notas, itens_por_nota=10, pct_malformados=0.0, semente=42, icms=VARIANTES_ICMS, pis_cofins=VARIANTES_PC, ipi=VARIANTES_IPI,
+                taxa_difal=TAXA_DIFAL):
+    # Gera (nome_arquivo, bytes) de forma determinística para a mesma semente e as mesmas variantes
+    _validar_variantes(icms, pis_cofins, ipi, taxa_difal)
+    rng = random.Random(semente)
+    for numero in range(1, n_notas + 1):
+        malformacao = rng.choice(MALFORMACOES) if rng.random() < pct_malformados else None
+        chave, xml = gerar_nota(rng, numero, itens_por_nota, malformacao, tuple(icms), tuple(pis_cofins), tuple(ipi), taxa_difal)
+        yield f"NFe{chave}.xml", xml
+
+def gerar_zip(n_notas, itens_por_nota=10, pct_malformados=0.0, semente=42, destino=None, icms=VARIANTES_ICMS, pis_cofins=VARIANTES_PC,
+              ipi=VARIANTES_IPI, taxa_difal=TAXA_DIFAL):
+    # ZIP com as notas, em arquivo (destino) ou em memória (devolve um BytesIO com .name); data fixa nos membros
+    # para a mesma semente gerar os mesmos bytes
+    alvo = destino or io.BytesIO()
+    with zipfile.ZipFile(alvo, "w", zipfile.ZIP_DEFLATED) as zf:
+        for nome, xml in gerar_notas(n_notas, itens_por_nota, pct_malformados, semente, icms, pis_cofins, ipi, taxa_difal):
+            zf.writestr(zipfile.ZipInfo(nome, date_time=(2024, 1, 1, 0, 0, 0)), xml, compress_type=zipfile.ZIP_DEFLATED)
+    if destino: return destino
+    alvo.name = "notas.zip"; alvo.seek(0)
+    return alvo
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Gera NF-e sintéticas num ZIP ou numa pasta.")
+    p.add_argument("destino", help="arquivo .zip ou pasta")
+    p.add_argument("--notas", type=int, default=1000)
+    p.add_argument("--itens", type=int, default=10, help="itens por nota")
+    p.add_argument("--malformados", type=float, default=0.0, help="fração de notas malformadas (0 a 1)")
+    p.add_argument("--semente", type=int, default=42)
+    p.add_argument("--icms", nargs="+", choices=VARIANTES_ICMS, default=list(VARIANTES_ICMS), help="variantes de ICMS sorteadas")
+    p.add_argument("--pis-cofins", nargs="+", choices=VARIANTES_PC, default=list(VARIANTES_PC), help="variantes de PIS/COFINS sorteadas")
+    p.add_argument("--ipi", nargs="+", choices=VARIANTES_IPI, default=list(VARIANTES_IPI), help="variantes de IPI sorteadas (sem = item sem IPI)")
+    p.add_argument("--taxa-difal", type=float, default=TAXA_DIFAL, help="fração dos itens interestaduais com DIFAL (0 a 1)")
+    args = p.parse_args(argv)
+    if not 0.0 <= args.taxa_difal <= 1.0: p.error("--taxa-difal deve estar entre 0 e 1")
+    variantes = dict(icms=args.icms, pis_cofins=args.pis_cofins, ipi=args.ipi, taxa_difal=args.taxa_difal)
+    if args.destino.lower().endswith(".zip"): gerar_zip(args.notas, args.itens, args.malformados, args.semente, args.destino, **variantes)
+    else:
+        os.makedirs(args.destino, exist_ok=True)
+        for nome, xml in gerar_notas(args.notas, args.itens, args.malformados, args.semente, **variantes):
+            with open(os.path.join(args.destino, nome), "wb") as f: f.write(xml)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
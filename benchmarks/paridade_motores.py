@@ -0,0 +1,59 @@
+import argparse
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import motor_fiscal as mf
+from gerador_nfe import gerar_notas
+
+# Paridade do motor XML padrão ("stream") com o "legado": as mesmas notas, em variantes que aparecem nos
+# arquivos dos clientes, têm de gerar as mesmas linhas e falhar nos mesmos arquivos nos dois motores.
+#   python benchmarks/paridade_motores.py --notas 300
+
+def _sem_prologo(xml): return re.sub(rb'<\?xml[^?]*\?>', b'', xml)
+
+VARIANTES = {
+    "original": lambda xml: xml,
+    "latin1_sem_encoding": lambda xml: _sem_prologo(xml).decode("utf-8").encode("latin-1"),
+    "espaco_antes_prologo": lambda xml: b"\r\n  \t" + xml,
+    "bom_utf8": lambda xml: b"\xef\xbb\xbf" + _sem_prologo(xml),
+    "truncado": lambda xml: xml[: len(xml) // 2],
+    "truncado_no_item": lambda xml: xml[: xml.index(b"</det>") + 6],
+}
+
+def comparar(lote):
+    # (linhas, arquivos com falha) de cada motor pelo mesmo caminho usado na extração
+    resultado = {}
+    for motor in ("stream", "legado"):
+        linhas, _, falhas = mf._extrair_lote(lote, motor)
+        resultado[motor] = (linhas, sorted(nome for nome, _ in falhas))
+    return resultado
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Compara os motores XML stream e legado.")
+    p.add_argument("--notas", type=int, default=200)
+    p.add_argument("--itens", type=int, default=5, help="itens por nota")
+    p.add_argument("--malformados", type=float, default=0.1, help="fração de notas malformadas pelo gerador")
+    p.add_argument("--semente", type=int, default=42)
+    args = p.parse_args(argv)
+
+    notas = list(gerar_notas(args.notas, args.itens, args.malformados, args.semente))
+    divergentes = 0
+    for variante, transformar in VARIANTES.items():
+        lote = []
+        for nome, xml in notas:
+            try: lote.append((nome, transformar(xml)))
+            except ValueError: pass  # nota sem <det> completo (já malformada pelo gerador)
+        r = comparar(lote)
+        (l_s, f_s), (l_l, f_l) = r["stream"], r["legado"]
+        ok = l_s == l_l and f_s == f_l
+        divergentes += not ok
+        print(f"{'OK ' if ok else 'DIF'} {variante:<22} arquivos={len(lote):>5}  linhas stream={len(l_s):>6} legado={len(l_l):>6}"
+              f"  falhas stream={len(f_s):>4} legado={len(f_l):>4}")
+    return 1 if divergentes else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from motor_fiscal import extrair_dados_xml, gerar_excel_final, indice_autenticidade, versao_bases
+
+# Auditoria em segundo plano para a interface: cada execução vira uma tarefa num pool de threads compartilhado
+# pelo processo (todas as sessões do Streamlit), identificada pelo hash dos arquivos enviados + opções + versão das
+# bases. Mesma entrada → mesma tarefa: se já terminou o relatório volta na hora, se está rodando não é refeita.
+# A sessão só guarda a chave e consulta o andamento (etapa, notas lidas); reruns do script não interrompem nada.
+MAX_TAREFAS_SIMULTANEAS = int(os.environ.get("SENTINELA_TAREFAS", "4"))
+# Processos de leitura de XML por tarefa; 0 = automático (CPUs divididas pelas tarefas em execução naquele momento)
+WORKERS_POR_TAREFA = int(os.environ.get("SENTINELA_WORKERS", "0"))
+MAX_TAREFAS_GUARDADAS = 16  # tarefas concluídas mantidas (com o relatório) para reaproveitamento
+ETAPAS = {
+    "autenticidade": "Lendo autenticidade", "entradas": "Lendo XMLs de entrada", "saidas": "Lendo XMLs de saída",
+    "bases": "Carregando bases de regras", "auditoria": "Auditando", "gerenciais": "Lendo gerenciais",
+    "conciliacao": "Conciliando com o ERP", "escrita": "Gravando relatório",
+}
+_POOL = ThreadPoolExecutor(max_workers=MAX_TAREFAS_SIMULTANEAS, thread_name_prefix="sentinela")
+_TAREFAS = OrderedDict()
+_TRAVA = threading.Lock()
+
+def _copia(arquivo):
+    # Cópia com posição de leitura própria: o mesmo UploadedFile pode ser lido por outra tarefa ou pelo próximo rerun
+    if arquivo is None: return None
+    copia = io.BytesIO(arquivo.getvalue()); copia.name = getattr(arquivo, 'name', 'arquivo')
+    return copia
+
+def chave_execucao(grupos, opcoes):
+    h = hashlib.blake2b(digest_size=20)
+    for grupo, arquivos in grupos.items():
+        h.update(f"[{grupo}]".encode())
+        for f in arquivos:
+            conteudo = f.getvalue(); h.update(f"{f.name}\0{len(conteudo)}\0".encode()); h.update(conteudo)
+    h.update(json.dumps({'opcoes': opcoes, 'bases': versao_bases()}, sort_keys=True).encode())
+    return h.hexdigest()
+
+def _atualizar(chave, **campos):
+    with _TRAVA:
+        if chave in _TAREFAS: _TAREFAS[chave].update(campos)
+
+def _descartar_antigas():
+    # Chamado com a trava: remove as tarefas terminadas mais antigas acima do limite (as em andamento ficam)
+    for chave in [c for c, t in _TAREFAS.items() if t['status'] in ("concluida", "erro")]:
+        if len(_TAREFAS) <= MAX_TAREFAS_GUARDADAS: break
+        del _TAREFAS[chave]
+
+def _workers():
+    # Uma auditoria sozinha usa todas as CPUs; com outras rodando, cada uma fica com a sua parte. Tarefas que começam
+    # depois não reduzem o pool de quem já está extraindo (pode haver mais processos que CPUs por um tempo)
+    if WORKERS_POR_TAREFA > 0: return WORKERS_POR_TAREFA
+    with _TRAVA: rodando = sum(t['status'] == "executando" for t in _TAREFAS.values())
+    return max(1, (os.cpu_count() or 1) // max(1, rodando))
+
+def _executar(chave, entradas, saidas, ger_ent, ger_sai, autenticidade, opcoes):
+    _atualizar(chave, status="executando", inicio=time.time())
+    try:
+        _atualizar(chave, etapa="autenticidade")
+        indice = indice_autenticidade([pd.read_excel(a) for a in autenticidade]) if autenticidade else None
+        lidas, extracao = {}, {}
+        def extrair(files, fluxo, etapa):
+            _atualizar(chave, etapa=etapa)
+            def progresso(n): lidas[fluxo] = n; _atualizar(chave, notas=sum(lidas.values()))
+            return extrair_dados_xml(files, fluxo, df_autenticidade=indice, workers=_workers(), armazem=opcoes['armazem'],
+                                     empresa=opcoes['empresa'], metricas=extracao.setdefault(etapa, {}), progresso=progresso)
+        df_e, df_s = extrair(entradas, "Entrada", "entradas"), extrair(saidas, "Saída", "saidas")
+        metricas = {}
+        resultado = gerar_excel_final(df_e, df_s, file_ger_ent=ger_ent, file_ger_sai=ger_sai, metricas=metricas, formato=opcoes['formato'],
+                                      df_autenticidade=indice, canceladas=opcoes['canceladas'], progresso=lambda etapa: _atualizar(chave, etapa=etapa))
+        resumo = {
+            'ignorados': df_e.attrs.get('ignorados', 0) + df_s.attrs.get('ignorados', 0),
+            'duplicados': df_e.attrs.get('duplicados', 0) + df_s.attrs.get('duplicados', 0),
+            'falhas': df_e.attrs.get('falhas', []) + df_s.attrs.get('falhas', []),
+            'itens': {'entradas': len(df_e), 'saidas': len(df_s)}, 'metricas': metricas, 'extracao': extracao,
+        }
+        _atualizar(chave, status="concluida", resultado=resultado, resumo=resumo, fim=time.time())
+    except Exception as e:
+        _atualizar(chave, status="erro", erro=str(e), fim=time.time())
+
+def iniciar_auditoria(xml_ent, xml_sai, ger_ent=None, ger_sai=None, aut_ent=None, aut_sai=None, formato="xlsx", canceladas="excluir",
+                      armazem=None, empresa=""):
+    entradas, saidas = [_copia(f) for f in xml_ent or []], [_copia(f) for f in xml_sai or []]
+    ger_ent, ger_sai = _copia(ger_ent), _copia(ger_sai)
+    autenticidade = [_copia(a) for a in (aut_ent, aut_sai) if a]
+    # O armazém só evita reler notas; não muda o relatório e por isso não entra na chave
+    opcoes = {'formato': formato, 'canceladas': canceladas}
+    chave = chave_execucao({'entradas': entradas, 'saidas': saidas, 'ger_ent': [f for f in (ger_ent,) if f],
+                            'ger_sai': [f for f in (ger_sai,) if f], 'autenticidade': autenticidade}, opcoes)
+    with _TRAVA:
+        tarefa = _TAREFAS.get(chave)
+        if tarefa and tarefa['status'] != "erro":
+            _TAREFAS.move_to_end(chave); return chave
+        _TAREFAS[chave] = {'chave': chave, 'status': "fila", 'etapa': None, 'notas': 0, 'opcoes': opcoes, 'criada': time.time(),
+                           'inicio': None, 'fim': None, 'resultado': None, 'resumo': None, 'erro': None}
+        _descartar_antigas()
+    _POOL.submit(_executar, chave, entradas, saidas, ger_ent, ger_sai, autenticidade, dict(opcoes, armazem=armazem, empresa=empresa))
+    return chave
+
+def estado_tarefa(chave):
+    # Cópia rasa do estado (None se a chave não existe mais); 'passo' = índice da etapa atual em ETAPAS
+    with _TRAVA:
+        tarefa = _TAREFAS.get(chave)
+        if tarefa is None: return None
+        estado = dict(tarefa)
+    estado['passo'] = list(ETAPAS).index(estado['etapa']) if estado['etapa'] in ETAPAS else 0
+    return estado
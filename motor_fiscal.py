@@ -3,112 +3,660 @@ import numpy as np
 import xml.etree.ElementTree as ET
 import re
 import io
-import streamlit as st
+import os
+import hashlib
+import pickle
+import sqlite3
+import csv
+import multiprocessing
+import sys
+import tempfile
+import time
+import threading
+import tarfile
+import zipfile
+from itertools import chain, islice
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import xlsxwriter
+try: import psutil
+except ImportError: psutil = None
 
-def extrair_dados_xml(files, fluxo, df_autenticidade=None):
-    dados_lista = []
-    if not files: return pd.DataFrame()
+MOTOR_XML_PADRAO = "stream"
+_CAMPOS_PROD = ('NCM', 'CFOP', 'cProd', 'xProd', 'vProd')
+_GRUPOS_IMPOSTO = ('ICMS', 'PIS', 'COFINS', 'IPI', 'ICMSUFDest')
+
+def _tag_local(el):
+    t = el.tag
+    return t[t.rfind('}') + 1:]
+
+def _primeiros(raiz, tags):
+    # Equivale a raiz.find('.//tag') para cada tag, em uma única varredura da subárvore
+    achados = {}; it = raiz.iter(); next(it)
+    for el in it:
+        t = _tag_local(el)
+        if t in tags and t not in achados:
+            achados[t] = el
+            if len(achados) == len(tags): break
+    return achados
+
+def _filhos(el):
+    d = {}
+    for c in el: d.setdefault(_tag_local(c), c)
+    return d
+
+def _texto(el): return el.text if el is not None and el.text is not None else ""
+
+def _linha_det_stream(det, cab):
+    if 'emit' not in cab or 'dest' not in cab: raise ValueError("Nota sem emit/dest antes dos itens")
+    if 'data' not in cab:
+        dh = cab.get('dhEmi', "")
+        cab['data'] = pd.Timestamp(dh).replace(tzinfo=None) if dh else None
+    d = _filhos(det); prod = d.get('prod'); imp = d.get('imposto')
+    if prod is None: raise ValueError("Item sem grupo prod")
+    p = {t: _texto(el) for t, el in _primeiros(prod, _CAMPOS_PROD).items()}
+    v_prod = p.get('vProd', "")
+    linha = {
+        "CHAVE_ACESSO": cab.get('chave', ""), "NUM_NF": cab.get('nNF', ""), "DATA_EMISSAO": cab['data'],
+        "UF_EMIT": cab['emit'], "UF_DEST": cab['dest'],
+        "AC": int(det.attrib.get('nItem', '0')), "CFOP": p.get('CFOP', ""), "NCM": re.sub(r'\D', '', p.get('NCM', "")).zfill(8),
+        "COD_PROD": p.get('cProd', ""), "DESCR": p.get('xProd', ""), "VPROD": float(v_prod) if v_prod else 0.0,
+        "CST-ICMS": "", "BC-ICMS": 0.0, "VLR-ICMS": 0.0, "ALQ-ICMS": 0.0, "ICMS-ST": 0.0,
+        "CST-PIS": "", "CST-COF": "", "VAL-PIS": 0.0, "VAL-COF": 0.0, "BC-FED": 0.0,
+        "CST-IPI": "", "VAL-IPI": 0.0, "BC-IPI": 0.0, "ALQ-IPI": 0.0, "VAL-DIFAL": 0.0,
+        "VAL-FCP": 0.0, "VAL-FCPST": 0.0
+    }
+    if imp is None: return linha
+    g = _primeiros(imp, _GRUPOS_IMPOSTO)
+    if 'ICMS' in g:
+        for n in g['ICMS']:
+            f = _filhos(n); cst = f.get('CST')
+            if cst is None: cst = f.get('CSOSN')
+            if cst is not None: linha["CST-ICMS"] = cst.text.zfill(2)
+            for tag, col in (('vBC', "BC-ICMS"), ('vICMS', "VLR-ICMS"), ('pICMS', "ALQ-ICMS"), ('vICMSST', "ICMS-ST"), ('vFCP', "VAL-FCP"), ('vFCPST', "VAL-FCPST")):
+                if tag in f: linha[col] = float(f[tag].text)
+    if 'PIS' in g:
+        for n in g['PIS']:
+            f = _filhos(n)
+            if 'CST' in f: linha["CST-PIS"] = f['CST'].text.zfill(2)
+            if 'vBC' in f: linha["BC-FED"] = float(f['vBC'].text)
+            if 'vPIS' in f: linha["VAL-PIS"] = float(f['vPIS'].text)
+    if 'COFINS' in g:
+        for n in g['COFINS']:
+            f = _filhos(n)
+            if 'CST' in f: linha["CST-COF"] = f['CST'].text.zfill(2)
+            if 'vCOFINS' in f: linha["VAL-COF"] = float(f['vCOFINS'].text)
+    if 'IPI' in g:
+        f = _primeiros(g['IPI'], ('CST', 'vBC', 'pIPI', 'vIPI'))
+        if 'CST' in f: linha["CST-IPI"] = f['CST'].text.zfill(2)
+        if 'vBC' in f: linha["BC-IPI"] = float(f['vBC'].text)
+        if 'pIPI' in f: linha["ALQ-IPI"] = float(f['pIPI'].text)
+        if 'vIPI' in f: linha["VAL-IPI"] = float(f['vIPI'].text)
+    if 'ICMSUFDest' in g:
+        f = _filhos(g['ICMSUFDest'])
+        if 'vICMSUFDest' in f: linha["VAL-DIFAL"] = float(f['vICMSUFDest'].text)
+        if 'vFCPUFDest' in f: linha["VAL-FCP"] += float(f['vFCPUFDest'].text)
+    return linha
+
+def _notas_stream(conteudo_bruto):
+    # Lê os bytes direto (sem decode/regex), resolve o cabeçalho uma vez por nota e libera cada <det> após o uso.
+    # Devolve (linhas, erro do primeiro item inválido); XML malformado levanta ParseError antes de qualquer linha
+    cab, linhas, erro = {}, [], None
+    for evento, el in ET.iterparse(io.BytesIO(conteudo_bruto), events=('start', 'end')):
+        t = _tag_local(el)
+        if evento == 'start':
+            if t == 'infNFe' and 'chave' not in cab: cab['chave'] = el.attrib.get('Id', '')[3:]
+        elif t == 'det':
+            if erro is None:
+                try: linhas.append(_linha_det_stream(el, cab))
+                except Exception as e: erro = e
+            el.clear()
+        elif t in ('nNF', 'dhEmi'):
+            if t not in cab: cab[t] = _texto(el)
+        elif t in ('emit', 'dest') and t not in cab:
+            cab[t] = _texto(_primeiros(el, ('UF',)).get('UF'))
+    return linhas, erro
+
+def _linhas_xml_stream(conteudo_bruto):
+    try: linhas, erro = _notas_stream(conteudo_bruto)
+    except ET.ParseError:
+        # Mesmo tratamento do motor legado: bytes fora do UTF-8 viram U+FFFD e a declaração <?xml?> sai
+        # (arquivo sem encoding declarado em latin-1, espaços antes do prólogo)
+        texto_xml = re.sub(r'<\?xml[^?]*\?>', '', conteudo_bruto.decode('utf-8', errors='replace'))
+        linhas, erro = _notas_stream(texto_xml.encode('utf-8'))
+    # Como no motor legado: XML malformado não gera linha nenhuma; erro num item mantém só os itens anteriores
+    yield from linhas
+    if erro is not None: raise erro
+
+def _linhas_xml_legado(conteudo_bruto):
+    texto_xml = conteudo_bruto.decode('utf-8', errors='replace')
+    texto_xml = re.sub(r'<\?xml[^?]*\?>', '', texto_xml)
+    texto_xml = re.sub(r'\sxmlns(:\w+)?="[^"]+"', '', texto_xml)
+    root = ET.fromstring(texto_xml)
+    def buscar(caminho, raiz=root):
+        alvo = raiz.find(f'.//{caminho}')
+        return alvo.text if alvo is not None and alvo.text is not None else ""
+    inf_nfe = root.find('.//infNFe')
+    chave_acesso = inf_nfe.attrib.get('Id', '')[3:] if inf_nfe is not None else ""
+    for det in root.findall('.//det'):
+        prod = det.find('prod'); imp = det.find('imposto')
+        ncm_limpo = re.sub(r'\D', '', buscar('NCM', prod)).zfill(8)
+        linha = {
+            "CHAVE_ACESSO": chave_acesso, "NUM_NF": buscar('nNF'),
+            "DATA_EMISSAO": pd.to_datetime(buscar('dhEmi')).replace(tzinfo=None) if buscar('dhEmi') else None,
+            "UF_EMIT": buscar('UF', root.find('.//emit')), "UF_DEST": buscar('UF', root.find('.//dest')),
+            "AC": int(det.attrib.get('nItem', '0')), "CFOP": buscar('CFOP', prod), "NCM": ncm_limpo,
+            "COD_PROD": buscar('cProd', prod), "DESCR": buscar('xProd', prod),
+            "VPROD": float(buscar('vProd', prod)) if buscar('vProd', prod) else 0.0,
+            "CST-ICMS": "", "BC-ICMS": 0.0, "VLR-ICMS": 0.0, "ALQ-ICMS": 0.0, "ICMS-ST": 0.0,
+            "CST-PIS": "", "CST-COF": "", "VAL-PIS": 0.0, "VAL-COF": 0.0, "BC-FED": 0.0,
+            "CST-IPI": "", "VAL-IPI": 0.0, "BC-IPI": 0.0, "ALQ-IPI": 0.0, "VAL-DIFAL": 0.0,
+            "VAL-FCP": 0.0, "VAL-FCPST": 0.0 
+        }
+        if imp is not None:
+            icms_n = imp.find('.//ICMS')
+            if icms_n is not None:
+                for n in icms_n:
+                    cst = n.find('CST') if n.find('CST') is not None else n.find('CSOSN')
+                    if cst is not None: linha["CST-ICMS"] = cst.text.zfill(2)
+                    if n.find('vBC') is not None: linha["BC-ICMS"] = float(n.find('vBC').text)
+                    if n.find('vICMS') is not None: linha["VLR-ICMS"] = float(n.find('vICMS').text)
+                    if n.find('pICMS') is not None: linha["ALQ-ICMS"] = float(n.find('pICMS').text)
+                    if n.find('vICMSST') is not None: linha["ICMS-ST"] = float(n.find('vICMSST').text)
+                    if n.find('vFCP') is not None: linha["VAL-FCP"] = float(n.find('vFCP').text)
+                    if n.find('vFCPST') is not None: linha["VAL-FCPST"] = float(n.find('vFCPST').text)
+            pis = imp.find('.//PIS')
+            if pis is not None:
+                for p in pis:
+                    if p.find('CST') is not None: linha["CST-PIS"] = p.find('CST').text.zfill(2)
+                    if p.find('vBC') is not None: linha["BC-FED"] = float(p.find('vBC').text)
+                    if p.find('vPIS') is not None: linha["VAL-PIS"] = float(p.find('vPIS').text)
+            cof = imp.find('.//COFINS')
+            if cof is not None:
+                for c in cof:
+                    if c.find('CST') is not None: linha["CST-COF"] = c.find('CST').text.zfill(2)
+                    if c.find('vCOFINS') is not None: linha["VAL-COF"] = float(c.find('vCOFINS').text)
+            ipi_n = imp.find('.//IPI')
+            if ipi_n is not None:
+                cst_i = ipi_n.find('.//CST')
+                if cst_i is not None: linha["CST-IPI"] = cst_i.text.zfill(2)
+                if ipi_n.find('.//vBC') is not None: linha["BC-IPI"] = float(ipi_n.find('.//vBC').text)
+                if ipi_n.find('.//pIPI') is not None: linha["ALQ-IPI"] = float(ipi_n.find('.//pIPI').text)
+                if ipi_n.find('.//vIPI') is not None: linha["VAL-IPI"] = float(ipi_n.find('.//vIPI').text)
+            dif_n = imp.find('.//ICMSUFDest')
+            if dif_n is not None:
+                if dif_n.find('vICMSUFDest') is not None: linha["VAL-DIFAL"] = float(dif_n.find('vICMSUFDest').text)
+                if dif_n.find('vFCPUFDest') is not None: linha["VAL-FCP"] += float(dif_n.find('vFCPUFDest').text)
+        yield linha
+
+_MOTORES_XML = {"stream": _linhas_xml_stream, "legado": _linhas_xml_legado}
+MOTORES_XML = tuple(_MOTORES_XML)
+COLUNAS_XML = [
+    "CHAVE_ACESSO", "NUM_NF", "DATA_EMISSAO", "UF_EMIT", "UF_DEST", "AC", "CFOP", "NCM", "COD_PROD", "DESCR", "VPROD",
+    "CST-ICMS", "BC-ICMS", "VLR-ICMS", "ALQ-ICMS", "ICMS-ST", "CST-PIS", "CST-COF", "VAL-PIS", "VAL-COF", "BC-FED",
+    "CST-IPI", "VAL-IPI", "BC-IPI", "ALQ-IPI", "VAL-DIFAL", "VAL-FCP", "VAL-FCPST"
+]
+MIN_ARQUIVOS_PARALELO = 500  # abaixo disso subir processos custa mais do que economiza
+COLUNAS_CATEGORICAS = ["CHAVE_ACESSO", "NUM_NF", "UF_EMIT", "UF_DEST", "CFOP", "NCM", "CST-ICMS", "CST-PIS", "CST-COF", "CST-IPI"]
+_CATEGORIAS_COMPARTILHADAS = {"UF_DEST": "UF_EMIT"}  # mesmas categorias para UF_EMIT == UF_DEST funcionar
+ARQUIVOS_POR_LOTE = 200
+
+_EXT_TAR = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+def _membros_arquivo(nome, fobj, contagem):
+    # Expande ZIP/TAR (inclusive ZIP dentro de ZIP) membro a membro, sem extrair para disco
+    baixo = nome.lower()
+    if baixo.endswith('.zip'):
+        with zipfile.ZipFile(fobj) as zf:
+            for info in zf.infolist():
+                if info.is_dir(): continue
+                membro = f"{nome}/{info.filename}"
+                if info.filename.lower().endswith(('.zip',) + _EXT_TAR):
+                    yield from _membros_arquivo(membro, io.BytesIO(zf.read(info)), contagem)
+                elif info.filename.lower().endswith('.xml'):
+                    try: conteudo = zf.read(info)
+                    except Exception as e: conteudo = e
+                    contagem['xml'] += 1; yield membro, conteudo
+                else: contagem['ignorados'] += 1
+    elif baixo.endswith(_EXT_TAR):
+        with tarfile.open(fileobj=fobj, mode='r|*') as tf:
+            for info in tf:
+                if not info.isfile(): continue
+                membro = f"{nome}/{info.name}"
+                if info.name.lower().endswith(('.zip',) + _EXT_TAR):
+                    yield from _membros_arquivo(membro, io.BytesIO(tf.extractfile(info).read()), contagem)
+                elif info.name.lower().endswith('.xml'):
+                    try: conteudo = tf.extractfile(info).read()
+                    except Exception as e: conteudo = e
+                    contagem['xml'] += 1; yield membro, conteudo
+                else: contagem['ignorados'] += 1
+    else:
+        try: fobj.seek(0); conteudo = fobj.read()
+        except Exception as e: conteudo = e
+        contagem['xml'] += 1; yield nome, conteudo
+
+def _caminhos_pasta(pasta, contagem):
+    for raiz, pastas, arquivos in os.walk(pasta):
+        pastas.sort()
+        for nome in sorted(arquivos):
+            if nome.lower().endswith(('.xml', '.zip') + _EXT_TAR): yield os.path.join(raiz, nome)
+            else: contagem['ignorados'] += 1
+
+def _ler_arquivos(files, contagem):
     for f in files:
+        if isinstance(f, (str, os.PathLike)):
+            caminhos = _caminhos_pasta(f, contagem) if os.path.isdir(f) else [f]
+            for caminho in caminhos:
+                with open(caminho, 'rb') as fobj: yield from _membros_arquivo(os.fspath(caminho), fobj, contagem)
+        else:
+            nome = getattr(f, 'name', str(f))
+            try: f.seek(0)
+            except Exception: pass
+            yield from _membros_arquivo(nome, f, contagem)
+
+def _em_lotes(itens, tamanho):
+    lote = []
+    for item in itens:
+        lote.append(item)
+        if len(lote) >= tamanho: yield lote; lote = []
+    if lote: yield lote
+
+def _extrair_lote(lote, motor):
+    # Executa no processo filho: recebe [(nome, bytes)] e devolve linhas compactas (tuplas na ordem de COLUNAS_XML)
+    # e, por arquivo, (chave, nº de linhas, lido sem erro) para a deduplicação feita no processo principal
+    ler_linhas = _MOTORES_XML[motor]; linhas, notas, falhas = [], [], []
+    for nome, conteudo in lote:
+        inicio = len(linhas); ok = True
         try:
-            f.seek(0)
-            conteudo_bruto = f.read()
-            texto_xml = conteudo_bruto.decode('utf-8', errors='replace')
-            texto_xml = re.sub(r'<\?xml[^?]*\?>', '', texto_xml)
-            texto_xml = re.sub(r'\sxmlns(:\w+)?="[^"]+"', '', texto_xml)
-            root = ET.fromstring(texto_xml)
-            def buscar(caminho, raiz=root):
-                alvo = raiz.find(f'.//{caminho}')
-                return alvo.text if alvo is not None and alvo.text is not None else ""
-            inf_nfe = root.find('.//infNFe')
-            chave_acesso = inf_nfe.attrib.get('Id', '')[3:] if inf_nfe is not None else ""
-            for det in root.findall('.//det'):
-                prod = det.find('prod'); imp = det.find('imposto')
-                ncm_limpo = re.sub(r'\D', '', buscar('NCM', prod)).zfill(8)
-                linha = {
-                    "CHAVE_ACESSO": chave_acesso, "NUM_NF": buscar('nNF'),
-                    "DATA_EMISSAO": pd.to_datetime(buscar('dhEmi')).replace(tzinfo=None) if buscar('dhEmi') else None,
-                    "UF_EMIT": buscar('UF', root.find('.//emit')), "UF_DEST": buscar('UF', root.find('.//dest')),
-                    "AC": int(det.attrib.get('nItem', '0')), "CFOP": buscar('CFOP', prod), "NCM": ncm_limpo,
-                    "COD_PROD": buscar('cProd', prod), "DESCR": buscar('xProd', prod),
-                    "VPROD": float(buscar('vProd', prod)) if buscar('vProd', prod) else 0.0,
-                    "CST-ICMS": "", "BC-ICMS": 0.0, "VLR-ICMS": 0.0, "ALQ-ICMS": 0.0, "ICMS-ST": 0.0,
-                    "CST-PIS": "", "CST-COF": "", "VAL-PIS": 0.0, "VAL-COF": 0.0, "BC-FED": 0.0,
-                    "CST-IPI": "", "VAL-IPI": 0.0, "BC-IPI": 0.0, "ALQ-IPI": 0.0, "VAL-DIFAL": 0.0,
-                    "VAL-FCP": 0.0, "VAL-FCPST": 0.0 
-                }
-                if imp is not None:
-                    icms_n = imp.find('.//ICMS')
-                    if icms_n is not None:
-                        for n in icms_n:
-                            cst = n.find('CST') if n.find('CST') is not None else n.find('CSOSN')
-                            if cst is not None: linha["CST-ICMS"] = cst.text.zfill(2)
-                            if n.find('vBC') is not None: linha["BC-ICMS"] = float(n.find('vBC').text)
-                            if n.find('vICMS') is not None: linha["VLR-ICMS"] = float(n.find('vICMS').text)
-                            if n.find('pICMS') is not None: linha["ALQ-ICMS"] = float(n.find('pICMS').text)
-                            if n.find('vICMSST') is not None: linha["ICMS-ST"] = float(n.find('vICMSST').text)
-                            if n.find('vFCP') is not None: linha["VAL-FCP"] = float(n.find('vFCP').text)
-                            if n.find('vFCPST') is not None: linha["VAL-FCPST"] = float(n.find('vFCPST').text)
-                    pis = imp.find('.//PIS')
-                    if pis is not None:
-                        for p in pis:
-                            if p.find('CST') is not None: linha["CST-PIS"] = p.find('CST').text.zfill(2)
-                            if p.find('vBC') is not None: linha["BC-FED"] = float(p.find('vBC').text)
-                            if p.find('vPIS') is not None: linha["VAL-PIS"] = float(p.find('vPIS').text)
-                    cof = imp.find('.//COFINS')
-                    if cof is not None:
-                        for c in cof:
-                            if c.find('CST') is not None: linha["CST-COF"] = c.find('CST').text.zfill(2)
-                            if c.find('vCOFINS') is not None: linha["VAL-COF"] = float(c.find('vCOFINS').text)
-                    ipi_n = imp.find('.//IPI')
-                    if ipi_n is not None:
-                        cst_i = ipi_n.find('.//CST')
-                        if cst_i is not None: linha["CST-IPI"] = cst_i.text.zfill(2)
-                        if ipi_n.find('.//vBC') is not None: linha["BC-IPI"] = float(ipi_n.find('.//vBC').text)
-                        if ipi_n.find('.//pIPI') is not None: linha["ALQ-IPI"] = float(ipi_n.find('.//pIPI').text)
-                        if ipi_n.find('.//vIPI') is not None: linha["VAL-IPI"] = float(ipi_n.find('.//vIPI').text)
-                    dif_n = imp.find('.//ICMSUFDest')
-                    if dif_n is not None:
-                        if dif_n.find('vICMSUFDest') is not None: linha["VAL-DIFAL"] = float(dif_n.find('vICMSUFDest').text)
-                        if dif_n.find('vFCPUFDest') is not None: linha["VAL-FCP"] += float(dif_n.find('vFCPUFDest').text)
-                dados_lista.append(linha)
-        except: continue
-    return pd.DataFrame(dados_lista)
-
-def gerar_excel_final(df_ent, df_sai, file_ger_ent=None, file_ger_sai=None):
-    def limpar_txt(v): return str(v).replace('.0', '').strip()
-    def format_brl(v): return f"R$ {v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-    
+            if isinstance(conteudo, Exception): raise conteudo
+            for linha in ler_linhas(conteudo): linhas.append(tuple(linha.values()))
+        except Exception as e: falhas.append((nome, f"{type(e).__name__}: {e}")); ok = False
+        notas.append((linhas[inicio][0] if len(linhas) > inicio else "", len(linhas) - inicio, ok))
+    return linhas, notas, falhas
+
+def _contexto_processos():
+    # forkserver (ou spawn onde não existe): o pool pode nascer numa thread do executor da interface, e um fork
+    # copiaria travas presas por outras threads; o servidor já vem com este módulo importado
+    ctx = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+    if ctx.get_start_method() == "forkserver": ctx.set_forkserver_preload([__name__])
+    return ctx
+
+def _extrair_lotes_paralelo(lotes, motor, workers):
+    # Mantém no máximo 2 lotes por processo em voo e devolve os resultados na ordem de envio
+    with ProcessPoolExecutor(max_workers=workers, mp_context=_contexto_processos()) as ex:
+        pendentes = deque()
+        for lote in lotes:
+            pendentes.append(ex.submit(_extrair_lote, lote, motor))
+            if len(pendentes) >= workers * 2: yield pendentes.popleft().result()
+        while pendentes: yield pendentes.popleft().result()
+
+# --- ARMAZÉM INCREMENTAL DE EXTRAÇÕES (SQLite) ---
+# Guarda as linhas extraídas de cada nota por (empresa, fluxo, motor XML, hash do conteúdo), com a chave de acesso
+# e o período (AAAA-MM da emissão); numa nova execução só os arquivos novos ou alterados passam pelo parser.
+VERSAO_ARMAZEM = 2
+
+def _abrir_armazem(caminho):
+    conn = sqlite3.connect(caminho, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    if conn.execute("PRAGMA user_version").fetchone()[0] != VERSAO_ARMAZEM:
+        conn.execute("DROP TABLE IF EXISTS notas")
+        conn.execute(f"PRAGMA user_version = {VERSAO_ARMAZEM}")
+    conn.execute("""CREATE TABLE IF NOT EXISTS notas (
+        empresa TEXT NOT NULL, fluxo TEXT NOT NULL, motor TEXT NOT NULL, hash TEXT NOT NULL, chave TEXT NOT NULL,
+        periodo TEXT NOT NULL, linhas BLOB NOT NULL, gravado_em TEXT NOT NULL,
+        PRIMARY KEY (empresa, fluxo, motor, hash))""")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_notas_chave ON notas (empresa, fluxo, motor, chave)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_notas_periodo ON notas (empresa, periodo)")
+    return conn
+
+def _hash_conteudo(conteudo): return hashlib.blake2b(conteudo, digest_size=16).hexdigest()
+
+def _periodo(linhas):
+    data = linhas[0][2] if linhas else None
+    return data.strftime('%Y-%m') if data is not None and not pd.isna(data) else ""
+
+def _consultar_armazem(conn, empresa, fluxo, motor, hashes):
+    if not hashes: return {}
+    marcas = ",".join("?" * len(hashes))
+    cur = conn.execute(f"SELECT hash, chave, linhas FROM notas WHERE empresa=? AND fluxo=? AND motor=? AND hash IN ({marcas})",
+                       [empresa, fluxo, motor, *hashes])
+    return {h: (chave, pickle.loads(blob)) for h, chave, blob in cur}
+
+def _gravar_armazem(conn, empresa, fluxo, motor, novos):
+    agora = pd.Timestamp.now().isoformat(timespec='seconds')
+    with conn:
+        for h, chave, linhas in novos:
+            # Mesma chave com outro conteúdo (XML substituído): a versão anterior sai do armazém
+            if chave: conn.execute("DELETE FROM notas WHERE empresa=? AND fluxo=? AND motor=? AND chave=? AND hash<>?", (empresa, fluxo, motor, chave, h))
+            conn.execute("INSERT OR REPLACE INTO notas VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (empresa, fluxo, motor, h, chave, _periodo(linhas), pickle.dumps(linhas, protocol=pickle.HIGHEST_PROTOCOL), agora))
+
+def limpar_armazem(caminho, empresa=None, periodo=None, fluxo=None):
+    # Invalida as notas guardadas (todas, ou filtradas por empresa/período AAAA-MM/fluxo); devolve quantas saíram
+    filtros = [(c, v) for c, v in (('empresa', empresa), ('periodo', periodo), ('fluxo', fluxo)) if v is not None]
+    where = " AND ".join(f"{c}=?" for c, _ in filtros) or "1=1"
+    conn = _abrir_armazem(caminho)
     try:
-        base_icms = pd.read_excel(".streamlit/Base_ICMS.xlsx")
-        base_icms['NCM_KEY'] = base_icms.iloc[:, 0].apply(limpar_txt).str.replace(r'\D', '', regex=True).str.zfill(8)
-        base_icms['CST_KEY'] = base_icms.iloc[:, 2].apply(limpar_txt).str.zfill(2)
-    except: base_icms = pd.DataFrame()
+        with conn: return conn.execute(f"DELETE FROM notas WHERE {where}", [v for _, v in filtros]).rowcount
+    finally: conn.close()
+
+def _extrair_com_armazem(lotes, extrair, conn, empresa, fluxo, motor, contagem):
+    # Separa, por lote, as notas já guardadas (pelo hash do conteúdo) das que precisam de parser e remonta a ordem original
+    planos = deque()
+    def faltantes():
+        for lote in lotes:
+            hashes = [_hash_conteudo(c) if isinstance(c, bytes) else None for _, c in lote]
+            achados = _consultar_armazem(conn, empresa, fluxo, motor, [h for h in hashes if h])
+            planos.append((hashes, achados))
+            yield [item for item, h in zip(lote, hashes) if h not in achados]
+    for linhas, notas, falhas in extrair(faltantes()):
+        hashes, achados = planos.popleft()
+        saida, notas_saida, novos, k, ini = [], [], [], 0, 0
+        for h in hashes:
+            if h in achados:
+                chave, ls = achados[h]; ok = True; contagem['em_armazem'] += 1
+            else:
+                chave, n, ok = notas[k]; k += 1; ls = linhas[ini:ini + n]; ini += n
+                if ok and h: novos.append((h, chave, ls))
+            saida.extend(ls); notas_saida.append((chave, len(ls), ok))
+        if novos: _gravar_armazem(conn, empresa, fluxo, motor, novos)
+        yield saida, notas_saida, falhas
+
+# --- BUFFERS COLUNARES TIPADOS ---
+# As linhas de cada lote são transpostas direto para buffers por coluna: códigos int32 para as categóricas,
+# array('d')/array('q') para os numéricos; o DataFrame final é montado sem passar por objetos por célula.
+def _novos_buffers():
+    dicionarios, buffers = {}, []
+    for col in COLUNAS_XML:
+        if col in COLUNAS_CATEGORICAS: buffers.append(('cat', array('i'), dicionarios.setdefault(_CATEGORIAS_COMPARTILHADAS.get(col, col), {})))
+        elif col == "AC": buffers.append(('int', array('q'), None))
+        elif col in ("DATA_EMISSAO", "COD_PROD", "DESCR"): buffers.append(('obj', [], None))
+        else: buffers.append(('float', array('d'), None))
+    return buffers
+
+def _acumular(buffers, linhas):
+    if not linhas: return
+    for (tipo, buf, dic), valores in zip(buffers, zip(*linhas)):
+        if tipo == 'cat': buf.extend([dic.setdefault(v, len(dic)) for v in valores])
+        else: buf.extend(valores)
+
+def _montar_df(buffers):
+    dados = {}
+    for col, (tipo, buf, dic) in zip(COLUNAS_XML, buffers):
+        if tipo == 'cat':
+            # Categorias em ordem alfabética (groupby/sort iguais aos de colunas texto)
+            cats = np.array(list(dic), dtype=object); ordem = np.argsort(cats, kind='stable')
+            novo_codigo = np.empty(len(cats), dtype=np.int32); novo_codigo[ordem] = np.arange(len(cats), dtype=np.int32)
+            dados[col] = pd.Categorical.from_codes(novo_codigo[np.frombuffer(buf, dtype=np.int32)], categories=cats[ordem])
+        elif tipo == 'int': dados[col] = np.frombuffer(buf, dtype=np.int64).astype(np.int32)
+        elif tipo == 'float': dados[col] = np.frombuffer(buf, dtype=np.float64).copy()
+        else: dados[col] = buf
+    return pd.DataFrame(dados)
+
+# --- MEMÓRIA POR EXECUÇÃO ---
+# Com psutil, uma thread amostra o RSS do processo + filhos (workers da extração) enquanto a execução roda e guarda o
+# maior valor; as outras tarefas do mesmo processo entram na conta. Sem psutil fica o ru_maxrss (pico do processo
+# desde o início, não só desta execução).
+INTERVALO_AMOSTRA_MEMORIA = 0.1
+
+def _pico_memoria_mb():
+    # Pico de memória residente do processo (ru_maxrss); indisponível no Windows
+    try: import resource
+    except ImportError: return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(pico / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def _rss_mb(proc):
+    total = 0
+    for p in [proc, *proc.children(recursive=True)]:
+        try: total += p.memory_info().rss
+        except psutil.Error: pass  # filho que terminou entre a listagem e a leitura
+    return total / (1024 * 1024)
+
+def medir_memoria():
+    # Começa a medir; devolve a função que encerra a medição e dá o pico (MB) desde esta chamada
+    if psutil is None: return _pico_memoria_mb
+    proc, parar = psutil.Process(), threading.Event(); pico = [_rss_mb(proc)]
+    def amostrar():
+        while not parar.wait(INTERVALO_AMOSTRA_MEMORIA): pico[0] = max(pico[0], _rss_mb(proc))
+    t = threading.Thread(target=amostrar, name="sentinela-memoria", daemon=True); t.start()
+    def encerrar():
+        parar.set(); t.join()
+        return round(max(pico[0], _rss_mb(proc)), 1)
+    return encerrar
+
+def _medindo_memoria(metricas, fn):
+    # Roda fn(); com metricas, grava nelas o pico de memória da execução
+    if metricas is None: return fn()
+    encerrar = medir_memoria()
+    try: return fn()
+    finally: metricas['pico_memoria_mb'] = encerrar()
+
+# --- AUTENTICIDADE ---
+# A(s) planilha(s) de autenticidade viram um dict chave de 44 dígitos → status, montado uma vez e consultado por
+# categoria de CHAVE_ACESSO (uma busca por nota, não por item). Canceladas/denegadas saem das abas de auditoria
+# ou ficam nelas sinalizadas pela coluna de status; chaves da planilha sem XML vão para uma aba própria.
+COLUNA_STATUS = "STATUS_SEFAZ"
+STATUS_SEM_AUTENTICIDADE = "Não consta na autenticidade"
+STATUS_EXCLUIDOS = ('CANCEL', 'DENEG', 'INUTIL')  # trechos do status (em maiúsculas) que tiram a nota da auditoria
+TRATAMENTO_CANCELADAS = ("excluir", "sinalizar")
+
+def _coluna_por_nome(df, trechos, padrao):
+    return next((c for c in df.columns if any(t in str(c).upper() for t in trechos)), padrao)
+
+def _canceladas(status): return status.astype(str).str.upper().str.contains('|'.join(STATUS_EXCLUIDOS), regex=True)
+
+def indice_autenticidade(df_autenticidade):
+    # Aceita um DataFrame, uma lista deles (entrada + saída) ou um índice já montado; None = sem autenticidade
+    if df_autenticidade is None or isinstance(df_autenticidade, dict): return df_autenticidade
+    planilhas = df_autenticidade if isinstance(df_autenticidade, (list, tuple)) else [df_autenticidade]
+    chaves, status = [], []
+    for df in planilhas:
+        if df is None or df.empty: continue
+        col_chave = _coluna_por_nome(df, ('CHAVE',), df.columns[0])
+        col_status = _coluna_por_nome(df, ('STATUS', 'SITUA'), df.columns[1] if df.shape[1] > 1 else None)
+        chaves.append(df[col_chave].astype(str).str.replace(r'\D', '', regex=True))
+        status.append(df[col_status].fillna("").astype(str).str.strip() if col_status is not None else pd.Series("", index=df.index))
+    if not chaves: return {}
+    pares = pd.DataFrame({'CHAVE': pd.concat(chaves, ignore_index=True), 'STATUS': pd.concat(status, ignore_index=True)})
+    pares = pares[pares['CHAVE'].str.len() == 44]
+    # Chave repetida (autorização + cancelamento): o status que exclui a nota prevalece
+    pares = pares.iloc[np.argsort(_canceladas(pares['STATUS']).to_numpy(), kind='stable')]
+    return dict(zip(pares['CHAVE'].tolist(), pares['STATUS'].tolist()))
+
+def _chaves_categorias(chaves):
+    # Chaves de acesso só com dígitos, uma por categoria (na ordem de chaves.cat.categories)
+    return pd.Series(chaves.cat.categories).astype(str).str.replace(r'\D', '', regex=True).tolist()
+
+def aplicar_autenticidade(df, indice):
+    if indice is None or df.empty or COLUNA_STATUS in df.columns: return df
+    chaves = df['CHAVE_ACESSO'].astype('category')
+    mapa = {c: indice.get(d, STATUS_SEM_AUTENTICIDADE) for c, d in zip(chaves.cat.categories, _chaves_categorias(chaves))}
+    df = df.copy(deep=False); df.insert(1, COLUNA_STATUS, chaves.map(mapa).astype('category'))
+    return df
+
+def _itens_cancelados(df):
+    # Máscara dos itens de notas canceladas/denegadas (avaliada por categoria de status, não por item)
+    if df.empty or COLUNA_STATUS not in df.columns: return pd.Series(False, index=df.index)
+    cats = df[COLUNA_STATUS].cat.categories
+    return df[COLUNA_STATUS].isin(cats[_canceladas(pd.Series(cats)).to_numpy()])
+
+def _para_auditoria(df, canceladas):
+    # Itens que entram nas abas de auditoria e a quantidade de itens de notas canceladas/denegadas
+    if df.empty or COLUNA_STATUS not in df.columns: return df, 0
+    excluidos = _itens_cancelados(df); n = int(excluidos.sum())
+    return (df[~excluidos] if n and canceladas == "excluir" else df), n
+
+def autenticidade_sem_xml(indice, *dfs):
+    # Chaves da autenticidade que não apareceram em nenhum XML extraído
+    if not indice: return pd.DataFrame()
+    vistas = set(chain.from_iterable(_chaves_categorias(df['CHAVE_ACESSO'].astype('category')) for df in dfs if not df.empty))
+    # Filtra no dict antes de montar o DataFrame: Series.isin em colunas str custa segundos com centenas de milhares de chaves
+    faltantes = [c for c in indice if c not in vistas]
+    res = pd.DataFrame({'CHAVE': faltantes, 'STATUS': [indice[c] for c in faltantes]}, dtype=str)
+    if res.empty: return res.reset_index(drop=True)
+    res = res.sort_values('CHAVE', ignore_index=True); ch = res['CHAVE'].str
+    res['AAMM'], res['CNPJ_EMIT'], res['MODELO'], res['SERIE'], res['NUM_NF'] = ch[2:6], ch[6:20], ch[20:22], ch[22:25], ch[25:34]
+    return res
+
+def extrair_dados_xml(files, fluxo, df_autenticidade=None, motor=MOTOR_XML_PADRAO, workers=None, armazem=None, empresa="", metricas=None,
+                      progresso=None):
+    return _medindo_memoria(metricas, lambda: _extrair_dados_xml(files, fluxo, df_autenticidade, motor, workers, armazem, empresa, metricas,
+                                                                 progresso))
+
+def _extrair_dados_xml(files, fluxo, df_autenticidade, motor, workers, armazem, empresa, metricas, progresso):
+    if motor not in _MOTORES_XML: raise ValueError(f"Motor XML desconhecido: {motor}")
+    if not files: return pd.DataFrame()
+    workers = workers or os.cpu_count() or 1
+    contagem = {'xml': 0, 'ignorados': 0, 'duplicados': 0, 'em_armazem': 0}
+    itens = _ler_arquivos(files, contagem)
+    # Arquivos compactados não têm tamanho conhecido: olha os primeiros itens para decidir entre serial e paralelo
+    inicio = list(islice(itens, MIN_ARQUIVOS_PARALELO))
+    lotes = _em_lotes(chain(inicio, itens), ARQUIVOS_POR_LOTE)
+    if workers > 1 and len(inicio) >= MIN_ARQUIVOS_PARALELO: extrair = lambda ls: _extrair_lotes_paralelo(ls, motor, workers)
+    else: extrair = lambda ls: (_extrair_lote(lote, motor) for lote in ls)
+    conn = _abrir_armazem(armazem) if armazem else None
     try:
-        base_pc = pd.read_excel(".streamlit/Base_CST_Pis_Cofins.xlsx")
-        base_pc['NCM_KEY'] = base_pc.iloc[:, 0].apply(limpar_txt).str.replace(r'\D', '', regex=True).str.zfill(8)
-        base_pc.columns = [c.upper() for c in base_pc.columns]
-    except: base_pc = pd.DataFrame()
+        resultados = _extrair_com_armazem(lotes, extrair, conn, empresa, fluxo, motor, contagem) if conn else extrair(lotes)
+        buffers, n_linhas, n_notas, falhas, chaves_vistas = _novos_buffers(), 0, 0, [], set()
+        for linhas, notas, falhas_lote in resultados:
+            i, aceitas = 0, []
+            for chave, n, _ in notas:
+                if chave and chave in chaves_vistas: contagem['duplicados'] += 1
+                else: chaves_vistas.add(chave); aceitas.extend(linhas[i:i + n])
+                i += n
+            _acumular(buffers, aceitas); n_linhas += len(aceitas)
+            falhas.extend(falhas_lote); n_notas += len(notas)
+            if progresso: progresso(n_notas)
+    finally:
+        if conn: conn.close()
+    df = aplicar_autenticidade(_montar_df(buffers), indice_autenticidade(df_autenticidade)) if n_linhas else pd.DataFrame()
+    df.attrs['arquivos'] = contagem['xml']; df.attrs['ignorados'] = contagem['ignorados']
+    df.attrs['duplicados'] = contagem['duplicados']; df.attrs['em_armazem'] = contagem['em_armazem']; df.attrs['falhas'] = falhas
+    if metricas is not None:
+        metricas['memoria_df_mb'] = round(float(df.memory_usage(deep=True).sum()) / 1e6, 1)
+    return df
 
-    if df_sai is None: df_sai = pd.DataFrame()
-    if df_ent is None: df_ent = pd.DataFrame()
+MOTOR_AUDITORIA_PADRAO = "vetorizado"
+CFOPS_DIFAL = ['6107', '6108', '6933', '6404']
+
+def _limpar_txt(v): return str(v).replace('.0', '').strip()
+def _format_brl(v): return f"R$ {v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+def _brl(serie): return [_format_brl(v) for v in serie.tolist()]
+def _zero(numerico): return 0.0 if numerico else "R$ 0,00"
+
+def _moeda(serie, numerico):
+    # Valor monetário: texto "R$ 1.234,56" no relatório padrão, float quando o escritor aplica o formato BRL
+    return serie.astype(float) if numerico else pd.Series(_brl(serie), index=serie.index, dtype=object)
+
+# --- BASES DE REGRAS COMPILADAS ---
+# Cada planilha é compilada uma vez para uma tabela compacta (uma linha por NCM_KEY) e gravada ao lado do
+# xlsx; o cache é reaproveitado entre execuções/sessões e refeito quando o mtime ou o hash do xlsx mudam.
+PASTA_BASES = os.environ.get("SENTINELA_BASES", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".streamlit"))
+CAMINHOS_BASES = {
+    "icms": os.path.join(PASTA_BASES, "Base_ICMS.xlsx"),
+    "pis_cofins": os.path.join(PASTA_BASES, "Base_CST_Pis_Cofins.xlsx"),
+    "tipi": os.path.join(PASTA_BASES, "Base_IPI_Tipi.xlsx"),
+}
+VERSAO_COMPILADOR = 1
+_CACHE_BASES = {}
+_TRAVA_BASES = threading.Lock()
+
+def _ncm_key(serie): return serie.apply(_limpar_txt).str.replace(r'\D', '', regex=True).str.zfill(8)
 
-    # --- ABA ICMS ---
-    df_icms_audit = df_sai.copy(); tem_e = not df_ent.empty
-    ncm_st = df_ent[(df_ent['CST-ICMS']=="60") | (df_ent['ICMS-ST'] > 0)]['NCM'].unique().tolist() if tem_e else []
+def _compilar_icms(caminho):
+    df = pd.read_excel(caminho)
+    base = pd.DataFrame({'NCM_KEY': _ncm_key(df.iloc[:, 0]), 'CST_KEY': df.iloc[:, 2].apply(_limpar_txt).str.zfill(2), 'ALIQ': df.iloc[:, 3]})
+    return base.drop_duplicates('NCM_KEY').reset_index(drop=True)
+
+def _compilar_pis_cofins(caminho):
+    df = pd.read_excel(caminho)
+    df['NCM_KEY'] = _ncm_key(df.iloc[:, 0]); df.columns = [c.upper() for c in df.columns]
+    cols = ['NCM_KEY'] + [c for c in ('CST_PIS', 'CST_COFINS', 'CST_IPI', 'ALQ_IPI') if c in df.columns]
+    return df[cols].drop_duplicates('NCM_KEY').reset_index(drop=True)
+
+def _compilar_tipi(caminho):
+    # TIPI: NCM com pontos na 1ª coluna e alíquota (% ou "NT") na 4ª; só as linhas de NCM completo (8 dígitos)
+    df = pd.read_excel(caminho, header=None)
+    ncm = df.iloc[:, 0].astype(str).str.replace(r'\D', '', regex=True)
+    aliq = df.iloc[:, 3].astype(str).str.strip().str.upper()
+    ok = (ncm.str.len() == 8) & df.iloc[:, 3].notna()
+    base = pd.DataFrame({'NCM_KEY': ncm[ok], 'ALQ_TIPI': pd.to_numeric(aliq[ok].str.replace(',', '.'), errors='coerce'), 'NT': aliq[ok] == 'NT'})
+    return base.drop_duplicates('NCM_KEY').reset_index(drop=True)
+
+_COMPILADORES = {"icms": _compilar_icms, "pis_cofins": _compilar_pis_cofins, "tipi": _compilar_tipi}
+
+def _hash_arquivo(caminho):
+    h = hashlib.sha256()
+    with open(caminho, 'rb') as f:
+        for bloco in iter(lambda: f.read(1 << 20), b""): h.update(bloco)
+    return h.hexdigest()
+
+def carregar_base(tipo, caminho=None):
+    caminho = caminho or CAMINHOS_BASES[tipo]
+    st_arq = os.stat(caminho); assinatura = (st_arq.st_mtime_ns, st_arq.st_size)
+    with _TRAVA_BASES:
+        em_memoria = _CACHE_BASES.get(caminho)
+        if em_memoria and em_memoria['assinatura'] == assinatura: return em_memoria['dados']
+        arq_cache = caminho + ".cache.pkl"; compilado = None
+        try:
+            with open(arq_cache, 'rb') as f: compilado = pickle.load(f)
+            if compilado.get('versao') != VERSAO_COMPILADOR: compilado = None
+        except Exception: compilado = None
+        gravar = compilado is None or compilado['assinatura'] != assinatura
+        if compilado and compilado['assinatura'] != assinatura:
+            # mtime mudou (ex.: upload do mesmo arquivo pela barra lateral): só recompila se o conteúdo mudou
+            hash_atual = _hash_arquivo(caminho)
+            compilado = dict(compilado, assinatura=assinatura) if compilado['hash'] == hash_atual else None
+        if compilado is None:
+            compilado = {'versao': VERSAO_COMPILADOR, 'assinatura': assinatura, 'hash': _hash_arquivo(caminho), 'dados': _COMPILADORES[tipo](caminho)}
+        if gravar:
+            try:
+                tmp = f"{arq_cache}.{os.getpid()}.tmp"
+                with open(tmp, 'wb') as f: pickle.dump(compilado, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, arq_cache)
+            except OSError: pass
+        _CACHE_BASES[caminho] = compilado
+        return compilado['dados']
+
+def versao_bases():
+    # Hash de conteúdo de cada base (compila se necessário); identifica a versão das regras usada numa execução
+    versoes = {}
+    for tipo, caminho in CAMINHOS_BASES.items():
+        try: carregar_base(tipo); versoes[tipo] = _CACHE_BASES[caminho]['hash']
+        except Exception: versoes[tipo] = None
+    return versoes
+
+def _carregar_bases():
+    bases = []
+    for tipo in ("icms", "pis_cofins", "tipi"):
+        try: bases.append(carregar_base(tipo))
+        except: bases.append(pd.DataFrame())
+    return tuple(bases)
+
+def _ncm_st(df_ent):
+    tem_e = not df_ent.empty
+    return (df_ent[(df_ent['CST-ICMS']=="60") | (df_ent['ICMS-ST'] > 0)]['NCM'].unique().tolist() if tem_e else []), tem_e
+
+# --- REGRAS LINHA A LINHA (motor "legado") ---
+def _auditar_icms_legado(df_sai, df_ent, base_icms):
+    df_icms_audit = df_sai.copy(deep=False); ncm_st, tem_e = _ncm_st(df_ent)
     def audit_icms(row):
         ncm = str(row['NCM']).zfill(8); info = base_icms[base_icms['NCM_KEY'] == ncm] if not base_icms.empty else pd.DataFrame()
         st_e = "✅ ST Localizado" if ncm in ncm_st else "❌ Sem ST na Entrada" if tem_e else "⚠️ Sem Entrada"
-        if info.empty: return pd.Series([st_e, "NCM Ausente", format_brl(row['VPROD']), "R$ 0,00", "Cadastrar NCM", "R$ 0,00"])
-        cst_e, aliq_e = str(info.iloc[0]['CST_KEY']), float(info.iloc[0, 3]) if row['UF_EMIT'] == row['UF_DEST'] else 12.0
+        if info.empty: return pd.Series([st_e, "NCM Ausente", _format_brl(row['VPROD']), "R$ 0,00", "Cadastrar NCM", "R$ 0,00"])
+        cst_e, aliq_e = str(info.iloc[0]['CST_KEY']), float(info.iloc[0]['ALIQ']) if row['UF_EMIT'] == row['UF_DEST'] else 12.0
         diag, acao = [], []
         if str(row['CST-ICMS']).zfill(2) != cst_e.zfill(2): diag.append("CST: Divergente"); acao.append(f"Cc-e (CST {cst_e})")
         if abs(row['ALQ-ICMS'] - aliq_e) > 0.01: diag.append("Aliq: Divergente"); acao.append("Ajustar Alíquota")
-        return pd.Series([st_e, "; ".join(diag) if diag else "✅ Correto", format_brl(row['VPROD']), format_brl(row['BC-ICMS']*aliq_e/100), " + ".join(acao) if acao else "✅ Correto", format_brl(max(0, (aliq_e-row['ALQ-ICMS'])*row['BC-ICMS']/100))])
+        return pd.Series([st_e, "; ".join(diag) if diag else "✅ Correto", _format_brl(row['VPROD']), _format_brl(row['BC-ICMS']*aliq_e/100), " + ".join(acao) if acao else "✅ Correto", _format_brl(max(0, (aliq_e-row['ALQ-ICMS'])*row['BC-ICMS']/100))])
     if not df_icms_audit.empty:
         df_icms_audit[['ST na Entrada', 'Diagnóstico', 'ICMS XML', 'ICMS Esperado', 'Ação', 'Complemento']] = df_icms_audit.apply(audit_icms, axis=1)
+    return df_icms_audit
 
-    # --- ABA PIS/COFINS ---
-    df_pc = df_sai.copy()
+def _auditar_pis_cofins_legado(df_sai, base_pc):
+    df_pc = df_sai.copy(deep=False)
     def audit_pc(row):
         ncm = str(row['NCM']).zfill(8); info = base_pc[base_pc['NCM_KEY'] == ncm] if not base_pc.empty else pd.DataFrame()
         if info.empty: return pd.Series(["NCM não mapeado", f"P/C: {row['CST-PIS']}/{row['CST-COF']}", "-", "Cadastrar NCM"])
@@ -120,89 +668,432 @@ def gerar_excel_final(df_ent, df_sai, file_ger_ent=None, file_ger_sai=None):
         return pd.Series(["; ".join(diag) if diag else "✅ Correto", f"P/C: {row['CST-PIS']}/{row['CST-COF']}", f"P/C: {cp_e}/{cc_e}", " + ".join(acao) if acao else "✅ Correto"])
     if not df_pc.empty:
         df_pc[['Diagnóstico', 'CST XML (P/C)', 'CST Esperado (P/C)', 'Ação']] = df_pc.apply(audit_pc, axis=1)
+    return df_pc
 
-    # --- ABA IPI ---
-    df_ipi = df_sai.copy()
+def _aliquotas_tipi(base_tipi):
+    if base_tipi is None or base_tipi.empty: return {}
+    return dict(zip(base_tipi['NCM_KEY'], base_tipi['ALQ_TIPI'].fillna(0.0)))
+
+def _auditar_ipi_legado(df_sai, base_pc, base_tipi=None):
+    df_ipi = df_sai.copy(deep=False); aliq_tipi = _aliquotas_tipi(base_tipi)
     def audit_ipi(row):
         ncm = str(row['NCM']).zfill(8); info = base_pc[base_pc['NCM_KEY'] == ncm] if not base_pc.empty else pd.DataFrame()
-        if info.empty: return pd.Series(["NCM não mapeado", row['CST-IPI'], "-", format_brl(row['VAL-IPI']), "R$ 0,00", "Cadastrar NCM", "R$ 0,00"])
+        if info.empty: return pd.Series(["NCM não mapeado", row['CST-IPI'], "-", _format_brl(row['VAL-IPI']), "R$ 0,00", "Cadastrar NCM", "R$ 0,00"])
         try: ci_e, ai_e = str(info.iloc[0]['CST_IPI']).zfill(2), float(info.iloc[0]['ALQ_IPI'])
-        except: ci_e, ai_e = "50", 0.0
+        except: ci_e, ai_e = "50", aliq_tipi.get(ncm, 0.0)
         v_e = row['BC-IPI'] * (ai_e/100); diag, acao = [] ,[]
         if str(row['CST-IPI']) != ci_e: diag.append("CST: Divergente"); acao.append(f"Cc-e (CST IPI {ci_e})")
         if abs(row['VAL-IPI'] - v_e) > 0.01: diag.append("Valor: Divergente"); acao.append("Complementar" if row['VAL-IPI'] < v_e else "Estornar")
-        return pd.Series(["; ".join(diag) if diag else "✅ Correto", row['CST-IPI'], ci_e, format_brl(row['VAL-IPI']), format_brl(v_e), " + ".join(acao) if acao else "✅ Correto", format_brl(max(0, v_e-row['VAL-IPI']))])
+        return pd.Series(["; ".join(diag) if diag else "✅ Correto", row['CST-IPI'], ci_e, _format_brl(row['VAL-IPI']), _format_brl(v_e), " + ".join(acao) if acao else "✅ Correto", _format_brl(max(0, v_e-row['VAL-IPI']))])
     if not df_ipi.empty:
         df_ipi[['Diagnóstico', 'CST XML', 'CST Base', 'IPI XML', 'IPI Esperado', 'Ação', 'Complemento']] = df_ipi.apply(audit_ipi, axis=1)
+    return df_ipi
 
-    # --- ABA DIFAL ---
-    df_difal = df_sai.copy()
+def _auditar_difal_legado(df_sai):
+    df_difal = df_sai.copy(deep=False)
     def audit_difal(row):
         is_i = row['UF_EMIT'] != row['UF_DEST']; cfop = str(row['CFOP']); diag, acao = [], []
         if is_i:
-            if cfop in ['6107', '6108', '6933', '6404']:
+            if cfop in CFOPS_DIFAL:
                 if row['VAL-DIFAL'] == 0: diag.append(f"CFOP {cfop}: DIFAL Obrigatório"); acao.append("Complementar DIFAL")
                 else: diag.append("✅ Correto"); acao.append("✅ Correto")
             else: diag.append("✅ Correto"); acao.append("✅ Correto")
         else: diag.append("✅ Correto"); acao.append("✅ Correto")
-        return pd.Series(["; ".join(diag), format_brl(row['VAL-DIFAL']), "; ".join(acao)])
+        return pd.Series(["; ".join(diag), _format_brl(row['VAL-DIFAL']), "; ".join(acao)])
     if not df_difal.empty:
         df_difal[['Diagnóstico', 'DIFAL XML', 'Ação']] = df_difal.apply(audit_difal, axis=1)
+    return df_difal
+
+# --- REGRAS VETORIZADAS (motor "vetorizado") ---
+# Cada base é reduzida a uma linha por NCM_KEY (a primeira, como o info.iloc[0] das regras linha a linha)
+# e cruzada uma única vez com os itens; diagnósticos e valores saem de máscaras sobre colunas inteiras.
+def _indice_ncm(base):
+    return base.drop_duplicates('NCM_KEY').set_index('NCM_KEY')
+
+def _juntar(partes, sep, vazio="✅ Correto"):
+    # Equivale ao sep.join(lista) das regras linha a linha: partes = [(máscara, texto)], na ordem de inclusão
+    res = pd.Series("", index=partes[0][0].index, dtype=object)
+    for mascara, texto in partes:
+        novo = (res + sep + texto).where(res != "", texto)
+        res = novo.where(mascara, res)
+    return res.where(res != "", vazio)
+
+def _auditar_icms_vetorizado(df_sai, df_ent, base_icms, numerico=False):
+    df = df_sai.copy(deep=False); ncm_st, tem_e = _ncm_st(df_ent)
+    if df.empty: return df
+    ncm = df['NCM'].astype(str).str.zfill(8)
+    st_e = np.where(ncm.isin(ncm_st), "✅ ST Localizado", "❌ Sem ST na Entrada" if tem_e else "⚠️ Sem Entrada")
+    icms_xml = _moeda(df['VPROD'], numerico); zero = _zero(numerico)
+    if base_icms.empty:
+        df[['ST na Entrada', 'Diagnóstico', 'ICMS XML', 'ICMS Esperado', 'Ação', 'Complemento']] = pd.DataFrame(
+            {0: st_e, 1: "NCM Ausente", 2: icms_xml, 3: zero, 4: "Cadastrar NCM", 5: zero}, index=df.index)
+        return df
+    ref = _indice_ncm(base_icms)
+    tem = ncm.isin(ref.index)
+    cst_e = ncm.map(ref['CST_KEY']).astype(object).where(tem, "").map(str)
+    aliq_e = pd.Series(12.0, index=df.index)
+    usa_base = tem & (df['UF_EMIT'] == df['UF_DEST'])
+    if usa_base.any(): aliq_e[usa_base] = ncm[usa_base].map(ref['ALIQ']).map(float)
+    d_cst = df['CST-ICMS'].astype(str).str.zfill(2) != cst_e.str.zfill(2)
+    d_aliq = (df['ALQ-ICMS'] - aliq_e).abs() > 0.01
+    diag = _juntar([(d_cst, "CST: Divergente"), (d_aliq, "Aliq: Divergente")], "; ")
+    acao = _juntar([(d_cst, "Cc-e (CST " + cst_e + ")"), (d_aliq, "Ajustar Alíquota")], " + ")
+    compl = (aliq_e - df['ALQ-ICMS']) * df['BC-ICMS'] / 100
+    esperado = _moeda(df['BC-ICMS'] * aliq_e / 100, numerico)
+    complemento = _moeda(compl.where(compl > 0, 0.0), numerico)
+    df[['ST na Entrada', 'Diagnóstico', 'ICMS XML', 'ICMS Esperado', 'Ação', 'Complemento']] = pd.DataFrame({
+        0: st_e, 1: diag.where(tem, "NCM Ausente"), 2: icms_xml, 3: esperado.where(tem, zero),
+        4: acao.where(tem, "Cadastrar NCM"), 5: complemento.where(tem, zero)}, index=df.index)
+    return df
+
+def _auditar_pis_cofins_vetorizado(df_sai, base_pc, numerico=False):
+    df = df_sai.copy(deep=False)
+    if df.empty: return df
+    ncm = df['NCM'].astype(str).str.zfill(8)
+    cst_pis, cst_cof = df['CST-PIS'].astype(str), df['CST-COF'].astype(str)
+    xml_pc = "P/C: " + cst_pis + "/" + cst_cof
+    if base_pc.empty: tem = pd.Series(False, index=df.index); cp_e = cc_e = pd.Series("01", index=df.index)
+    else:
+        ref = _indice_ncm(base_pc); tem = ncm.isin(ref.index)
+        if 'CST_PIS' in ref.columns and 'CST_COFINS' in ref.columns:
+            cp_e = ncm.map(ref['CST_PIS'].map(lambda v: str(v).zfill(2))).astype(object).where(tem, "")
+            cc_e = ncm.map(ref['CST_COFINS'].map(lambda v: str(v).zfill(2))).astype(object).where(tem, "")
+        else: cp_e = cc_e = pd.Series("01", index=df.index, dtype=object)
+    d_pis, d_cof = cst_pis != cp_e, cst_cof != cc_e
+    diag = _juntar([(d_pis, "PIS: Divergente"), (d_cof, "COF: Divergente")], "; ")
+    acao = _juntar([(d_pis, "Cc-e (CST PIS " + cp_e + ")"), (d_cof, "Cc-e (CST COF " + cc_e + ")")], " + ")
+    df[['Diagnóstico', 'CST XML (P/C)', 'CST Esperado (P/C)', 'Ação']] = pd.DataFrame({
+        0: diag.where(tem, "NCM não mapeado"), 1: xml_pc, 2: ("P/C: " + cp_e + "/" + cc_e).where(tem, "-"),
+        3: acao.where(tem, "Cadastrar NCM")}, index=df.index)
+    return df
+
+def _regras_ipi(ref):
+    # (CST, alíquota, veio da base) por NCM; sem CST_IPI/ALQ_IPI válidos o CST é "50" e a alíquota sai da TIPI
+    if 'CST_IPI' not in ref.columns or 'ALQ_IPI' not in ref.columns:
+        return pd.Series("50", index=ref.index), pd.Series(0.0, index=ref.index), pd.Series(False, index=ref.index)
+    # Válida = aceita por float(): número, vazio (NaN) ou o texto "nan"
+    alq = pd.to_numeric(ref['ALQ_IPI'], errors='coerce')
+    ok = alq.notna() | ref['ALQ_IPI'].isna() | ref['ALQ_IPI'].astype(str).str.strip().str.lower().isin(('nan', '+nan', '-nan'))
+    return ref['CST_IPI'].map(lambda v: str(v).zfill(2)).where(ok, "50"), alq.where(ok, 0.0), ok
+
+def _auditar_ipi_vetorizado(df_sai, base_pc, base_tipi=None, numerico=False):
+    df = df_sai.copy(deep=False)
+    if df.empty: return df
+    ncm = df['NCM'].astype(str).str.zfill(8)
+    ipi_xml = _moeda(df['VAL-IPI'], numerico); zero = _zero(numerico)
+    if base_pc.empty:
+        tem = pd.Series(False, index=df.index); ci_e = pd.Series("50", index=df.index); ai_e = pd.Series(0.0, index=df.index)
+    else:
+        ref = _indice_ncm(base_pc); tem = ncm.isin(ref.index)
+        cst_b, alq_b, ok_b = _regras_ipi(ref)
+        ci_e = ncm.map(cst_b).astype(object).where(tem, "")
+        da_base = ncm.map(ok_b).eq(True)
+        ai_e = ncm.map(alq_b).where(da_base, ncm.map(pd.Series(_aliquotas_tipi(base_tipi), dtype=float)).fillna(0.0)).where(tem, 0.0)
+    v_e = df['BC-IPI'] * (ai_e / 100)
+    d_cst = df['CST-IPI'].astype(str) != ci_e
+    d_val = (df['VAL-IPI'] - v_e).abs() > 0.01
+    diag = _juntar([(d_cst, "CST: Divergente"), (d_val, "Valor: Divergente")], "; ")
+    acao = _juntar([(d_cst, "Cc-e (CST IPI " + ci_e + ")"), (d_val, pd.Series(np.where(df['VAL-IPI'] < v_e, "Complementar", "Estornar"), index=df.index))], " + ")
+    compl = v_e - df['VAL-IPI']
+    df[['Diagnóstico', 'CST XML', 'CST Base', 'IPI XML', 'IPI Esperado', 'Ação', 'Complemento']] = pd.DataFrame({
+        0: diag.where(tem, "NCM não mapeado"), 1: df['CST-IPI'], 2: ci_e.where(tem, "-"), 3: ipi_xml,
+        4: _moeda(v_e, numerico).where(tem, zero), 5: acao.where(tem, "Cadastrar NCM"),
+        6: _moeda(compl.where(compl > 0, 0.0), numerico).where(tem, zero)}, index=df.index)
+    return df
+
+def _auditar_difal_vetorizado(df_sai, numerico=False):
+    df = df_sai.copy(deep=False)
+    if df.empty: return df
+    cfop = df['CFOP'].astype(str)
+    obrig = (df['UF_EMIT'] != df['UF_DEST']) & cfop.isin(CFOPS_DIFAL) & (df['VAL-DIFAL'] == 0)
+    df[['Diagnóstico', 'DIFAL XML', 'Ação']] = pd.DataFrame({
+        0: ("CFOP " + cfop + ": DIFAL Obrigatório").where(obrig, "✅ Correto"), 1: _moeda(df['VAL-DIFAL'], numerico),
+        2: np.where(obrig, "Complementar DIFAL", "✅ Correto")}, index=df.index)
+    return df
+
+_MOTORES_AUDITORIA = {
+    "legado": (_auditar_icms_legado, _auditar_pis_cofins_legado, _auditar_ipi_legado, _auditar_difal_legado),
+    "vetorizado": (_auditar_icms_vetorizado, _auditar_pis_cofins_vetorizado, _auditar_ipi_vetorizado, _auditar_difal_vetorizado),
+}
+MOTORES_AUDITORIA = tuple(_MOTORES_AUDITORIA)
+
+def _regras(motor, numerico):
+    if motor not in _MOTORES_AUDITORIA: raise ValueError(f"Motor de auditoria desconhecido: {motor}")
+    if numerico and motor != "vetorizado": raise ValueError("Valores numéricos só estão disponíveis no motor vetorizado")
+    return _MOTORES_AUDITORIA[motor], ({'numerico': True} if numerico else {})
+
+def auditar_icms(df_sai, df_ent, base_icms, motor=MOTOR_AUDITORIA_PADRAO, numerico=False):
+    regras, kw = _regras(motor, numerico); return regras[0](df_sai, df_ent, base_icms, **kw)
+def auditar_pis_cofins(df_sai, base_pc, motor=MOTOR_AUDITORIA_PADRAO, numerico=False):
+    regras, kw = _regras(motor, numerico); return regras[1](df_sai, base_pc, **kw)
+def auditar_ipi(df_sai, base_pc, base_tipi=None, motor=MOTOR_AUDITORIA_PADRAO, numerico=False):
+    regras, kw = _regras(motor, numerico); return regras[2](df_sai, base_pc, base_tipi, **kw)
+def auditar_difal(df_sai, motor=MOTOR_AUDITORIA_PADRAO, numerico=False):
+    regras, kw = _regras(motor, numerico); return regras[3](df_sai, **kw)
+
+def resumo_icms_destino(df_sai, numerico=False):
+    if df_sai.empty: return pd.DataFrame()
+    df_dest = df_sai.groupby('UF_DEST', observed=True).agg({'ICMS-ST': 'sum', 'VAL-DIFAL': 'sum', 'VAL-FCP': 'sum', 'VAL-FCPST': 'sum'}).reset_index()
+    df_dest.columns = ['ESTADO', 'ST', 'DIFAL', 'FCP', 'FCP-ST']
+    if not numerico:
+        for col in ['ST', 'DIFAL', 'FCP', 'FCP-ST']: df_dest[col] = df_dest[col].apply(_format_brl)
+    return df_dest
+
+# --- GERENCIAIS E CONCILIAÇÃO ---
+# O CSV do ERP é lido em blocos pelo engine C com separador, decimal e cabeçalho detectados numa amostra e colunas de
+# valor já tipadas como float (arquivo fora do padrão cai na leitura como texto com conversão coluna a coluna).
+# A conciliação agrega XML e gerencial por (NF, item) e junta as duas tabelas pelo índice (hash join, sem laços).
+COLUNAS_GER_SAI = ['NF','DATA_EMISSAO','CNPJ','Ufp','VC','AC','CFOP','COD_ITEM','VUNIT','QTDE','VITEM','DESC','FRETE','SEG','OUTRAS','VC_ITEM','CST','Coluna2','Coluna3','BC_ICMS','ALIQ_ICMS','ICMS','BC_ICMSST','ICMSST','IPI','CST_PIS','BC_PIS','PIS','CST_COF','BC_COF','COF']
+COLUNAS_GER_ENT = ['NUM_NF','DATA_EMISSAO','CNPJ','UF','VLR_NF','AC','CFOP','COD_PROD','DESCR','NCM','UNID','VUNIT','QTDE','VPROD','DESC','FRETE','SEG','DESP','VC','CST-ICMS','Coluna2','BC-ICMS','VLR-ICMS','BC-ICMS-ST','ICMS-ST','VLR_IPI','CST_PIS','BC_PIS','VLR_PIS','CST_COF','BC_COF','VLR_COF']
+_COLUNAS_VALOR_GER = {
+    'VLR_NF', 'VC', 'VUNIT', 'QTDE', 'VPROD', 'VITEM', 'DESC', 'FRETE', 'SEG', 'DESP', 'OUTRAS', 'VC_ITEM', 'BC-ICMS', 'VLR-ICMS',
+    'BC-ICMS-ST', 'ICMS-ST', 'VLR_IPI', 'BC_PIS', 'VLR_PIS', 'BC_COF', 'VLR_COF', 'BC_ICMS', 'ALIQ_ICMS', 'ICMS', 'BC_ICMSST',
+    'ICMSST', 'IPI', 'PIS', 'COF',
+}
+AMOSTRA_CSV = 64 * 1024
+LINHAS_POR_BLOCO_CSV = 200_000
+TOLERANCIA_CONCILIACAO = 0.01
+# fluxo → (coluna NF do gerencial, coluna item do gerencial, {imposto: (coluna gerencial, coluna XML)})
+CONCILIACAO = {
+    "Entrada": ('NUM_NF', 'AC', {"ICMS": ('VLR-ICMS', 'VLR-ICMS'), "ICMS-ST": ('ICMS-ST', 'ICMS-ST'), "IPI": ('VLR_IPI', 'VAL-IPI'),
+                                 "PIS": ('VLR_PIS', 'VAL-PIS'), "COFINS": ('VLR_COF', 'VAL-COF')}),
+    "Saída": ('NF', 'AC', {"ICMS": ('ICMS', 'VLR-ICMS'), "ICMS-ST": ('ICMSST', 'ICMS-ST'), "IPI": ('IPI', 'VAL-IPI'),
+                           "PIS": ('PIS', 'VAL-PIS'), "COFINS": ('COF', 'VAL-COF')}),
+}
+
+def _separador_csv(amostra): return ';' if amostra.count(';') > amostra.count(',') else ','
+
+def _decimal_csv(linhas, sep, colunas):
+    # Marca decimal vista só nas colunas de valor da amostra (descrições como "GARRAFA 1,5L" não contam);
+    # None quando a amostra mistura "1234,56" e "1234.56" e cada célula precisa ser convertida pelo _numero_br
+    posicoes = [i for i, c in enumerate(colunas) if c in _COLUNAS_VALOR_GER]
+    valores = [cel[i].strip() for cel in csv.reader(linhas, delimiter=sep) for i in posicoes if i < len(cel)]
+    virgula = any(re.search(r'\d,\d', v) for v in valores)
+    ponto = any(re.fullmatch(r'-?\d+\.\d{1,2}', v) for v in valores)
+    if virgula and ponto: return None
+    return ',' if virgula else '.'
+
+def _numero_br(serie):
+    # "R$ 1.234,56" / "1234,56" / "1234.56" → float; vazio ou inválido → NaN
+    s = serie.astype(str).str.replace(r'[^\d,.\-]', '', regex=True)
+    br = s.str.contains(',', regex=False)
+    s = s.where(~br, s.str.replace('.', '', regex=False).str.replace(',', '.', regex=False))
+    return pd.to_numeric(s, errors='coerce')
 
-    # --- ABA ICMS_DESTINO ---
-    if not df_sai.empty:
-        df_dest = df_sai.groupby('UF_DEST').agg({'ICMS-ST': 'sum', 'VAL-DIFAL': 'sum', 'VAL-FCP': 'sum', 'VAL-FCPST': 'sum'}).reset_index()
-        df_dest.columns = ['ESTADO', 'ST', 'DIFAL', 'FCP', 'FCP-ST']
-        for col in ['ST', 'DIFAL', 'FCP', 'FCP-ST']: df_dest[col] = df_dest[col].apply(format_brl)
-    else: df_dest = pd.DataFrame()
+def _ajustar_colunas(df, colunas):
+    # Evita o "Length mismatch": corta colunas extras ou completa as que faltam
+    if df.shape[1] > len(colunas): df = df.iloc[:, :len(colunas)]
+    for i in range(len(colunas) - df.shape[1]): df[f'Vazia_{i}'] = ""
+    df.columns = colunas
+    return df
 
-    # --- BLOCO GERENCIAIS (BLINDAGEM CONTRA LENGTH MISMATCH) ---
-    def load_gerencial_flexible(f, target_cols):
-        if not f: return pd.DataFrame()
+def _ler_blocos_csv(fobj, colunas, opcoes, tipado):
+    fobj.seek(0)
+    dtype = {i: 'float64' if tipado and c in _COLUNAS_VALOR_GER else str for i, c in enumerate(colunas)}
+    partes = [_ajustar_colunas(bloco, colunas) for bloco in pd.read_csv(fobj, dtype=dtype, chunksize=LINHAS_POR_BLOCO_CSV, **opcoes)]
+    return pd.concat(partes, ignore_index=True) if partes else pd.DataFrame()
+
+def carregar_gerencial(f, colunas):
+    if not f: return pd.DataFrame()
+    amostra = ""
+    try:
+        fobj = open(f, 'rb') if isinstance(f, (str, os.PathLike)) else f
         try:
-            f.seek(0)
-            raw = f.read().decode('utf-8-sig', errors='replace')
-            sep = ';' if raw.count(';') > raw.count(',') else ','
-            df = pd.read_csv(io.StringIO(raw), sep=sep, header=None, engine='python', dtype={0: str})
-            
-            if df.shape[0] > 0 and not str(df.iloc[0, 0]).strip().isdigit():
-                df = df.iloc[1:]
-
-            # Resolve o erro de "Length mismatch": pega apenas o número de colunas necessário
-            num_cols_df = df.shape[1]
-            num_cols_target = len(target_cols)
-            
-            if num_cols_df > num_cols_target:
-                df = df.iloc[:, :num_cols_target] # Corta colunas extras
-            elif num_cols_df < num_cols_target:
-                for i in range(num_cols_target - num_cols_df):
-                    df[f'Vazia_{i}'] = "" # Adiciona colunas se faltarem
-            
-            df.columns = target_cols
-            return df
-        except Exception as e:
-            return pd.DataFrame([{"ERRO": f"Falha na leitura: {str(e)}"}])
-
-    c_sai = ['NF','DATA_EMISSAO','CNPJ','Ufp','VC','AC','CFOP','COD_ITEM','VUNIT','QTDE','VITEM','DESC','FRETE','SEG','OUTRAS','VC_ITEM','CST','Coluna2','Coluna3','BC_ICMS','ALIQ_ICMS','ICMS','BC_ICMSST','ICMSST','IPI','CST_PIS','BC_PIS','PIS','CST_COF','BC_COF','COF']
-    c_ent = ['NUM_NF','DATA_EMISSAO','CNPJ','UF','VLR_NF','AC','CFOP','COD_PROD','DESCR','NCM','UNID','VUNIT','QTDE','VPROD','DESC','FRETE','SEG','DESP','VC','CST-ICMS','Coluna2','BC-ICMS','VLR-ICMS','BC-ICMS-ST','ICMS-ST','VLR_IPI','CST_PIS','BC_PIS','VLR_PIS','CST_COF','BC_COF','VLR_COF']
-    
-    df_ge = load_gerencial_flexible(file_ger_ent, c_ent)
-    df_gs = load_gerencial_flexible(file_ger_sai, c_sai)
+            fobj.seek(0); amostra = fobj.read(AMOSTRA_CSV).decode('utf-8-sig', errors='replace')
+            sep = _separador_csv(amostra)
+            # Cabeçalho: a primeira célula do arquivo não é um número de NF
+            linhas = amostra.splitlines(); i = next((n for n, l in enumerate(linhas) if l.strip()), 0)
+            cabecalho = not (linhas[i].split(sep)[0].strip().strip('"').isdigit() if linhas else False)
+            # A última linha da amostra pode estar cortada no meio de um valor
+            decimal = _decimal_csv(linhas[i + cabecalho:-1 if len(amostra) >= AMOSTRA_CSV else None], sep, colunas) if sep == ';' else '.'
+            opcoes = dict(sep=sep, header=None, engine='c', encoding='utf-8-sig', encoding_errors='replace', skiprows=i + 1 if cabecalho else None,
+                          decimal=decimal or '.', thousands='.' if decimal == ',' else None)
+            try:
+                if decimal is None: raise ValueError("marca decimal mista")
+                df = _ler_blocos_csv(fobj, colunas, opcoes, tipado=True)
+            except ValueError:
+                # Texto fora do padrão numa coluna de valor: lê tudo como texto e converte só as colunas que forem numéricas
+                df = _ler_blocos_csv(fobj, colunas, opcoes, tipado=False)
+                for col in _COLUNAS_VALOR_GER.intersection(df.columns):
+                    valor = _numero_br(df[col]); vazio = df[col].isna() | (df[col].astype(str).str.strip() == "")
+                    if (valor.notna() | vazio).all(): df[col] = valor
+        finally:
+            if fobj is not f: fobj.close()
+        return df
+    except Exception as e:
+        if isinstance(e, pd.errors.EmptyDataError) and amostra.strip(): return pd.DataFrame()  # só cabeçalho
+        return pd.DataFrame([{"ERRO": f"Falha na leitura: {str(e)}"}])
+
+def _chave_nf(serie):
+    # Número da NF só com dígitos ("000123" no XML == "123" no ERP); categóricas são normalizadas pelas categorias
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        cats = _chave_nf(pd.Series(serie.cat.categories)).array
+        return pd.Series(pd.api.extensions.take(cats, serie.cat.codes.to_numpy(), allow_fill=True), index=serie.index)
+    return pd.to_numeric(serie.astype(str).str.replace(r'\D', '', regex=True), errors='coerce').astype('Int64')
+
+def _chave_item(serie):
+    n = pd.to_numeric(serie, errors='coerce'); return n.where(n == n.round()).astype('Int64')
+
+def _valor(serie): return serie.astype(float) if pd.api.types.is_numeric_dtype(serie) else _numero_br(serie)
+
+def conciliar_gerencial(df_xml, df_ger, fluxo, numerico=False):
+    if df_xml.empty or df_ger.empty or 'ERRO' in df_ger.columns: return pd.DataFrame()
+    col_nf, col_item, impostos = CONCILIACAO[fluxo]
+
+    def agregar(df, nf, item, lado, i):
+        t = pd.DataFrame({'NF': _chave_nf(df[nf]), 'ITEM': _chave_item(df[item]), lado: 1}, index=df.index)
+        for imp, cols in impostos.items(): t[f"{imp} {lado}"] = _valor(df[cols[i]]).fillna(0.0)
+        return t.groupby(['NF', 'ITEM'], sort=False, dropna=False).sum()
 
+    # Itens de notas canceladas/denegadas na SEFAZ ficam na conciliação com o status no diagnóstico
+    canc = _itens_cancelados(df_xml)
+    status = pd.DataFrame({'NF': _chave_nf(df_xml['NUM_NF'][canc]), 'ITEM': _chave_item(df_xml['AC'][canc]),
+                           COLUNA_STATUS: df_xml[COLUNA_STATUS][canc].astype(str) if canc.any() else ""})
+    status = status.groupby(['NF', 'ITEM'], sort=False, dropna=False)[COLUNA_STATUS].first()
+    m = agregar(df_xml, 'NUM_NF', 'AC', "XML", 1).join(status).join(agregar(df_ger, col_nf, col_item, "Gerencial", 0), how='outer')
+    m = m.sort_index(na_position='last').reset_index()
+    no_xml, no_ger = m['XML'].notna(), m['Gerencial'].notna(); ambos = no_xml & no_ger
+    res = m[['NF', 'ITEM']].copy(); partes = []
+    for imp in impostos:
+        xml, ger = m[f"{imp} XML"], m[f"{imp} Gerencial"]; dif = xml.fillna(0.0) - ger.fillna(0.0)
+        partes.append((ambos & (dif.abs() > TOLERANCIA_CONCILIACAO), f"{imp}: Divergente"))
+        vazio = None if numerico else "-"
+        res[f"{imp} XML"] = _moeda(xml.fillna(0.0), numerico).where(no_xml, vazio)
+        res[f"{imp} Gerencial"] = _moeda(ger.fillna(0.0), numerico).where(no_ger, vazio)
+        res[f"Dif. {imp}"] = _moeda(dif, numerico).where(ambos, vazio)
+    diag = _juntar(partes, "; ", vazio="✅ Conciliado")
+    diag = np.where(~no_ger, "Item ausente no Gerencial", np.where(~no_xml, "Item ausente no XML", diag))
+    cancelada = m[COLUNA_STATUS].notna()
+    res.insert(2, 'Diagnóstico', np.where(cancelada, "Nota cancelada/denegada no XML (" + m[COLUNA_STATUS].fillna("").astype(str) + ")", diag))
+    return res
+
+# --- ESCRITA DO RELATÓRIO ---
+# "xlsx": relatório em memória com valores em texto "R$" (formato original).
+# "xlsx_streaming": xlsxwriter em constant_memory gravando linha a linha num arquivo; valores ficam numéricos com
+# formato BRL e abas acima do limite do Excel são divididas. "csv"/"parquet": um arquivo por aba para cargas de BI.
+FORMATOS_RELATORIO = ("xlsx", "xlsx_streaming", "csv", "parquet")
+LIMITE_LINHAS_EXCEL = 1_048_576
+LINHAS_POR_BLOCO = 50_000
+FORMATO_BRL = '[$R$-416] #,##0.00'
+COLUNAS_MOEDA = {
+    "VPROD", "BC-ICMS", "VLR-ICMS", "ICMS-ST", "VAL-PIS", "VAL-COF", "BC-FED", "VAL-IPI", "BC-IPI", "VAL-DIFAL", "VAL-FCP", "VAL-FCPST",
+    "ICMS XML", "ICMS Esperado", "IPI XML", "IPI Esperado", "DIFAL XML", "Complemento", "ST", "DIFAL", "FCP", "FCP-ST",
+    "ICMS Gerencial", "Dif. ICMS", "ICMS-ST XML", "ICMS-ST Gerencial", "Dif. ICMS-ST", "IPI Gerencial", "Dif. IPI",
+    "PIS XML", "PIS Gerencial", "Dif. PIS", "COFINS XML", "COFINS Gerencial", "Dif. COFINS",
+} | (_COLUNAS_VALOR_GER - {"QTDE", "ALIQ_ICMS"})  # valores dos dois gerenciais (quantidade e alíquota não são moeda)
+_ABAS_TEXTO_COL_A = ('Gerenc. Entradas', 'Gerenc. Saídas', 'Autenticidade sem XML')
+
+def _escrever_xlsx_memoria(abas):
     mem = io.BytesIO()
     with pd.ExcelWriter(mem, engine='xlsxwriter') as wr:
-        if not df_ent.empty: df_ent.to_excel(wr, sheet_name='ENTRADAS', index=False)
-        if not df_sai.empty: df_sai.to_excel(wr, sheet_name='SAIDAS', index=False)
-        if not df_icms_audit.empty: df_icms_audit.to_excel(wr, sheet_name='ICMS', index=False)
-        if not df_pc.empty: df_pc.to_excel(wr, sheet_name='PIS_COFINS', index=False)
-        if not df_ipi.empty: df_ipi.to_excel(wr, sheet_name='IPI', index=False)
-        if not df_difal.empty: df_difal.to_excel(wr, sheet_name='DIFAL', index=False)
-        if not df_dest.empty: df_dest.to_excel(wr, sheet_name='ICMS_Destino', index=False)
-        if not df_ge.empty: df_ge.to_excel(wr, sheet_name='Gerenc. Entradas', index=False)
-        if not df_gs.empty: df_gs.to_excel(wr, sheet_name='Gerenc. Saídas', index=False)
-
+        for nome, df in abas: df.to_excel(wr, sheet_name=nome, index=False)
         wb = wr.book; f_txt = wb.add_format({'num_format': '@'})
-        for s in ['Gerenc. Entradas', 'Gerenc. Saídas']:
+        for s in _ABAS_TEXTO_COL_A:
             if s in wr.sheets: wr.sheets[s].set_column('A:A', 20, f_txt)
-                
     return mem.getvalue()
+
+def _escrever_xlsx_streaming(abas, caminho):
+    wb = xlsxwriter.Workbook(caminho, {'constant_memory': True, 'strings_to_formulas': False, 'strings_to_urls': False})
+    f_brl = wb.add_format({'num_format': FORMATO_BRL}); f_data = wb.add_format({'num_format': 'dd/mm/yyyy hh:mm:ss'})
+    f_txt = wb.add_format({'num_format': '@'}); f_cab = wb.add_format({'bold': True})
+    max_linhas = LIMITE_LINHAS_EXCEL - 1
+    for nome, df in abas:
+        for parte, ini in enumerate(range(0, max(len(df), 1), max_linhas)):
+            ws = wb.add_worksheet(nome if parte == 0 else f"{nome[:27]} ({parte + 1})")
+            for j, col in enumerate(df.columns):
+                if col in COLUNAS_MOEDA: ws.set_column(j, j, 14, f_brl)
+                elif pd.api.types.is_datetime64_any_dtype(df[col]): ws.set_column(j, j, 19, f_data)
+            if nome in _ABAS_TEXTO_COL_A: ws.set_column(0, 0, 20, f_txt)
+            ws.write_row(0, 0, [str(c) for c in df.columns], f_cab)
+            linha = 1
+            for b in range(ini, min(ini + max_linhas, len(df)), LINHAS_POR_BLOCO):
+                bloco = df.iloc[b:min(b + LINHAS_POR_BLOCO, ini + max_linhas)]
+                colunas = [bloco[c].astype(object).where(bloco[c].notna(), None).tolist() for c in bloco.columns]
+                for valores in zip(*colunas): ws.write_row(linha, 0, valores); linha += 1
+    wb.close()
+
+def _nome_arquivo_aba(nome): return re.sub(r'\W+', '_', nome).strip('_')
+
+def _exportar_abas(abas, formato, destino):
+    # Um arquivo por aba dentro de um ZIP (destino=None → bytes) ou numa pasta (destino = diretório)
+    def gravar(df, f):
+        if formato == "csv": df.to_csv(f, index=False, encoding='utf-8')
+        else:
+            df = df.copy(deep=False)
+            for c in df.columns[df.dtypes == object]: df[c] = df[c].astype('string')
+            df.to_parquet(f, index=False)
+    if destino:
+        os.makedirs(destino, exist_ok=True)
+        for nome, df in abas: gravar(df, os.path.join(destino, f"{_nome_arquivo_aba(nome)}.{formato}"))
+        return destino
+    mem = io.BytesIO()
+    with zipfile.ZipFile(mem, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for nome, df in abas:
+            buf = io.BytesIO(); gravar(df, buf); zf.writestr(f"{_nome_arquivo_aba(nome)}.{formato}", buf.getvalue())
+    return mem.getvalue()
+
+def gerar_excel_final(df_ent, df_sai, file_ger_ent=None, file_ger_sai=None, motor_auditoria=MOTOR_AUDITORIA_PADRAO, metricas=None,
+                      formato="xlsx", destino=None, df_autenticidade=None, canceladas="excluir", progresso=None):
+    return _medindo_memoria(metricas, lambda: _gerar_excel_final(df_ent, df_sai, file_ger_ent, file_ger_sai, motor_auditoria, metricas,
+                                                                 formato, destino, df_autenticidade, canceladas, progresso))
+
+def _gerar_excel_final(df_ent, df_sai, file_ger_ent, file_ger_sai, motor_auditoria, metricas, formato, destino, df_autenticidade,
+                       canceladas, progresso):
+    if motor_auditoria not in _MOTORES_AUDITORIA: raise ValueError(f"Motor de auditoria desconhecido: {motor_auditoria}")
+    if formato not in FORMATOS_RELATORIO: raise ValueError(f"Formato de relatório desconhecido: {formato}")
+    if canceladas not in TRATAMENTO_CANCELADAS: raise ValueError(f"Tratamento de canceladas desconhecido: {canceladas}")
+    avisar = progresso or (lambda etapa: None)  # recebe o nome de cada etapa ao começar (bases, auditoria, ...)
+    numerico = formato != "xlsx"; etapas = {}; t0 = time.perf_counter(); avisar("bases")
+    base_icms, base_pc, base_tipi = _carregar_bases()
+    etapas['bases_s'] = time.perf_counter() - t0
+
+    if df_sai is None: df_sai = pd.DataFrame()
+    if df_ent is None: df_ent = pd.DataFrame()
+
+    # --- AUTENTICIDADE ---
+    avisar("auditoria"); t0 = time.perf_counter(); indice = indice_autenticidade(df_autenticidade)
+    df_ent, df_sai = aplicar_autenticidade(df_ent, indice), aplicar_autenticidade(df_sai, indice)
+    (aud_ent, canc_ent), (aud_sai, canc_sai) = _para_auditoria(df_ent, canceladas), _para_auditoria(df_sai, canceladas)
+    df_sem_xml = autenticidade_sem_xml(indice, df_ent, df_sai)
+    etapas['autenticidade_s'] = time.perf_counter() - t0
+
+    # --- ABAS DE AUDITORIA ---
+    t0 = time.perf_counter()
+    df_icms_audit = auditar_icms(aud_sai, aud_ent, base_icms, motor_auditoria, numerico)
+    df_pc = auditar_pis_cofins(aud_sai, base_pc, motor_auditoria, numerico)
+    df_ipi = auditar_ipi(aud_sai, base_pc, base_tipi, motor_auditoria, numerico)
+    df_difal = auditar_difal(aud_sai, motor_auditoria, numerico)
+    df_dest = resumo_icms_destino(aud_sai, numerico)
+    etapas['auditoria_s'] = time.perf_counter() - t0; t0 = time.perf_counter()
+
+    # --- GERENCIAIS E CONCILIAÇÃO ---
+    avisar("gerenciais")
+    df_ge = carregar_gerencial(file_ger_ent, COLUNAS_GER_ENT)
+    df_gs = carregar_gerencial(file_ger_sai, COLUNAS_GER_SAI)
+    etapas['gerenciais_s'] = time.perf_counter() - t0; t0 = time.perf_counter(); avisar("conciliacao")
+    df_conc_e = conciliar_gerencial(df_ent, df_ge, "Entrada", numerico)
+    df_conc_s = conciliar_gerencial(df_sai, df_gs, "Saída", numerico)
+    etapas['conciliacao_s'] = time.perf_counter() - t0; t0 = time.perf_counter(); avisar("escrita")
+
+    abas = [(nome, df) for nome, df in (
+        ('ENTRADAS', df_ent), ('SAIDAS', df_sai), ('ICMS', df_icms_audit), ('PIS_COFINS', df_pc), ('IPI', df_ipi),
+        ('DIFAL', df_difal), ('ICMS_Destino', df_dest), ('Gerenc. Entradas', df_ge), ('Gerenc. Saídas', df_gs),
+        ('Conciliação Entradas', df_conc_e), ('Conciliação Saídas', df_conc_s), ('Autenticidade sem XML', df_sem_xml)) if not df.empty]
+
+    if formato == "xlsx": resultado = _escrever_xlsx_memoria(abas)
+    elif formato == "xlsx_streaming":
+        if destino: _escrever_xlsx_streaming(abas, destino); resultado = destino
+        else:
+            fd, tmp = tempfile.mkstemp(suffix=".xlsx"); os.close(fd)
+            try:
+                _escrever_xlsx_streaming(abas, tmp)
+                with open(tmp, 'rb') as f: resultado = f.read()
+            finally: os.remove(tmp)
+    else: resultado = _exportar_abas(abas, formato, destino)
+
+    etapas['escrita_s'] = time.perf_counter() - t0
+    if metricas is not None:
+        metricas['etapas'] = {k: round(v, 3) for k, v in etapas.items()}
+        metricas['abas'] = {nome: len(df) for nome, df in abas}
+        metricas['itens_cancelados'] = {'entradas': canc_ent, 'saidas': canc_sai}
+    return resultado
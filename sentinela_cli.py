@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from motor_fiscal import (extrair_dados_xml, gerar_excel_final, indice_autenticidade, medir_memoria, FORMATOS_RELATORIO, MOTORES_XML,
+                          MOTORES_AUDITORIA, MOTOR_XML_PADRAO, MOTOR_AUDITORIA_PADRAO, TRATAMENTO_CANCELADAS)
+
+# Execução em lote (sem Streamlit): python sentinela_cli.py --saidas xmls/ notas.zip --relatorio auditoria.xlsx
+# Grava o relatório e um resumo JSON com arquivos lidos, itens, falhas e tempo de cada etapa.
+
+def _argumentos(argv):
+    p = argparse.ArgumentParser(prog="sentinela_cli", description="Auditoria fiscal Sentinela em linha de comando.")
+    p.add_argument("--entradas", nargs="*", default=[], help="XMLs, pastas ou arquivos ZIP/TAR de entrada")
+    p.add_argument("--saidas", nargs="*", default=[], help="XMLs, pastas ou arquivos ZIP/TAR de saída")
+    p.add_argument("--ger-entradas", help="CSV gerencial de entradas")
+    p.add_argument("--ger-saidas", help="CSV gerencial de saídas")
+    p.add_argument("--autenticidade", nargs="*", default=[], help="Planilha(s) de autenticidade (xlsx)")
+    p.add_argument("--canceladas", choices=TRATAMENTO_CANCELADAS, default="excluir", help="Notas canceladas/denegadas nas abas de auditoria")
+    p.add_argument("--relatorio", required=True, help="Arquivo do relatório (pasta quando o formato for csv/parquet)")
+    p.add_argument("--formato", choices=FORMATOS_RELATORIO, default="xlsx_streaming")
+    p.add_argument("--resumo", help="Arquivo JSON do resumo (padrão: <relatorio>.json)")
+    p.add_argument("--workers", type=int, help="Processos para a leitura dos XMLs (padrão: nº de CPUs)")
+    p.add_argument("--armazem", help="SQLite de extrações já feitas (leitura incremental)")
+    p.add_argument("--empresa", default="", help="Identificação da empresa no armazém")
+    p.add_argument("--motor-xml", choices=MOTORES_XML, default=MOTOR_XML_PADRAO)
+    p.add_argument("--motor-auditoria", choices=MOTORES_AUDITORIA, default=MOTOR_AUDITORIA_PADRAO)
+    args = p.parse_args(argv)
+    if not args.entradas and not args.saidas: p.error("informe --entradas e/ou --saidas")
+    # Só o formato "xlsx" leva valores em texto; os demais precisam dos valores numéricos do motor vetorizado
+    if args.motor_auditoria == "legado" and args.formato != "xlsx": p.error("--motor-auditoria legado só gera o formato xlsx")
+    return args
+
+def _resumo_extracao(df, metricas):
+    return {
+        "arquivos": df.attrs.get('arquivos', 0), "itens": len(df), "ignorados": df.attrs.get('ignorados', 0),
+        "duplicados": df.attrs.get('duplicados', 0), "em_armazem": df.attrs.get('em_armazem', 0),
+        "memoria_df_mb": metricas.get('memoria_df_mb', 0.0), "pico_memoria_mb": metricas.get('pico_memoria_mb'),
+        "falhas": [{"arquivo": a, "erro": e} for a, e in df.attrs.get('falhas', [])],
+    }
+
+def main(argv=None):
+    args = _argumentos(argv); encerrar_medicao = medir_memoria()
+    resumo = {"inicio": datetime.now().isoformat(timespec='seconds'), "relatorio": args.relatorio, "formato": args.formato, "etapas_s": {}}
+    caminho_resumo = args.resumo or f"{args.relatorio.rstrip(os.sep)}.json"
+    try:
+        t0 = time.perf_counter()
+        df_aut = indice_autenticidade([pd.read_excel(f) for f in args.autenticidade]) if args.autenticidade else None
+        if df_aut is not None: resumo["chaves_autenticidade"] = len(df_aut)
+        resumo["etapas_s"]["autenticidade"] = round(time.perf_counter() - t0, 3)
+
+        opcoes = dict(df_autenticidade=df_aut, motor=args.motor_xml, workers=args.workers, armazem=args.armazem, empresa=args.empresa)
+        met_e, met_s = {}, {}; t0 = time.perf_counter()
+        df_e = extrair_dados_xml(args.entradas, "Entrada", metricas=met_e, **opcoes)
+        resumo["etapas_s"]["extracao_entradas"] = round(time.perf_counter() - t0, 3); t0 = time.perf_counter()
+        df_s = extrair_dados_xml(args.saidas, "Saída", metricas=met_s, **opcoes)
+        resumo["etapas_s"]["extracao_saidas"] = round(time.perf_counter() - t0, 3)
+        resumo["entradas"], resumo["saidas"] = _resumo_extracao(df_e, met_e), _resumo_extracao(df_s, met_s)
+
+        metricas = {}; t0 = time.perf_counter()
+        ger_e = open(args.ger_entradas, 'rb') if args.ger_entradas else None
+        ger_s = open(args.ger_saidas, 'rb') if args.ger_saidas else None
+        try:
+            destino = None if args.formato == "xlsx" else args.relatorio
+            resultado = gerar_excel_final(df_e, df_s, file_ger_ent=ger_e, file_ger_sai=ger_s, motor_auditoria=args.motor_auditoria,
+                                          metricas=metricas, formato=args.formato, destino=destino, df_autenticidade=df_aut,
+                                          canceladas=args.canceladas)
+        finally:
+            for f in (ger_e, ger_s):
+                if f: f.close()
+        if args.formato == "xlsx":
+            with open(args.relatorio, 'wb') as f: f.write(resultado)
+        resumo["etapas_s"]["relatorio"] = round(time.perf_counter() - t0, 3)
+        resumo["etapas_s"].update({f"relatorio.{k[:-2]}": v for k, v in metricas.get('etapas', {}).items()})
+        resumo["abas"] = metricas.get('abas', {})
+        resumo["itens_cancelados"] = metricas.get('itens_cancelados', {})
+        resumo["relatorio_pico_memoria_mb"] = metricas.get('pico_memoria_mb')
+        resumo["status"] = "ok"
+    except Exception as e:
+        resumo["status"] = "erro"; resumo["erro"] = f"{type(e).__name__}: {e}"
+    resumo["fim"] = datetime.now().isoformat(timespec='seconds')
+    resumo["pico_memoria_mb"] = encerrar_medicao()
+    with open(caminho_resumo, 'w', encoding='utf-8') as f: json.dump(resumo, f, ensure_ascii=False, indent=2)
+    if resumo["status"] != "ok":
+        print(f"Erro: {resumo['erro']}", file=sys.stderr)
+        return 1
+    memoria_df = resumo['entradas']['memoria_df_mb'] + resumo['saidas']['memoria_df_mb']
+    print(f"Relatório: {args.relatorio} | itens: {resumo['entradas']['itens']} entradas, {resumo['saidas']['itens']} saídas "
+          f"({memoria_df:,.1f} MB em memória) | resumo: {caminho_resumo}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
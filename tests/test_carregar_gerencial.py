@@ -0,0 +1,34 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import motor_fiscal as mf
+
+# Gerencial de saídas: linha com os 31 campos de COLUNAS_GER_SAI; só os usados no teste variam
+def _linha_sai(nf, item, desc, vitem, icms):
+    campos = [""] * len(mf.COLUNAS_GER_SAI)
+    for col, v in (('NF', nf), ('AC', item), ('COD_ITEM', desc), ('VITEM', vitem), ('ICMS', icms), ('QTDE', "1")): campos[mf.COLUNAS_GER_SAI.index(col)] = v
+    return ";".join(campos)
+
+def _carregar(linhas):
+    return mf.carregar_gerencial(io.BytesIO("\n".join(linhas).encode("utf-8")), mf.COLUNAS_GER_SAI)
+
+def test_ponto_decimal_com_virgula_na_descricao():
+    # "GARRAFA 1,5L" fora das colunas de valor não pode trocar a marca decimal do arquivo
+    df = _carregar([_linha_sai("10", "1", "GARRAFA 1,5L", "1234.56", "18.50"), _linha_sai("11", "1", "CABO 2,5MM", "10.00", "1.80")])
+    assert df['VITEM'].tolist() == [1234.56, 10.0]
+    assert df['ICMS'].tolist() == [18.5, 1.8]
+
+def test_virgula_decimal_com_milhar():
+    df = _carregar([_linha_sai("10", "1", "GARRAFA 1,5L", "1.234,56", "18,50")])
+    assert df['VITEM'].tolist() == [1234.56]
+    assert df['ICMS'].tolist() == [18.5]
+
+def test_notacoes_misturadas_convertidas_por_celula():
+    df = _carregar([_linha_sai("10", "1", "A", "1234,56", "18.50"), _linha_sai("11", "1", "B", "10.00", "1,80")])
+    assert df['VITEM'].tolist() == pytest.approx([1234.56, 10.0])
+    assert df['ICMS'].tolist() == pytest.approx([18.5, 1.8])